@@ -0,0 +1,475 @@
+# -*- coding: utf-8 -*-
+"""
+Offline benchmark of a flooding detection cycle.
+
+Runs the real `pick_cameras` -> `get_snapshot` -> `upload_image_to_gcs` ->
+`prefilter_snapshot` -> `submit_prediction` -> `get_predictions` ->
+`update_flooding_api_data` path against local stand-ins: every camera streams a local
+video file, Gemini is replaced by a classifier with configurable latency and error rate
+(going through the real rate limiter and retries), GCS by an in-memory bucket and Redis by
+fakeredis, unless `--redis-url` is given. The sheets are seeded into the sheet cache, so
+nothing is downloaded.
+
+For each number of cameras it reports the cycle throughput, the p50/p95 latency of each
+stage and the peak memory, so regressions can be caught before deploy.
+
+Requires `fakeredis` (`pip install fakeredis`) when `--redis-url` isn't given.
+
+Usage:
+    python -m pipelines.deteccao_alagamento_cameras.flooding_detection.benchmark \\
+        --cameras 10 100 1000 --classifier-latency 1.5 --json benchmark.json
+"""
+import argparse
+import asyncio
+import json
+import random
+import resource
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+import cv2
+import numpy as np
+import pandas as pd
+import redis
+from google.api_core import exceptions as google_exceptions
+from redis_pal import RedisPal
+
+from pipelines.deteccao_alagamento_cameras.flooding_detection.service import (
+    get_default_parameters,
+)
+from pipelines.deteccao_alagamento_cameras.flooding_detection.tasks import (
+    get_predictions,
+    get_snapshot,
+    pick_cameras,
+    prefilter_snapshot,
+    submit_prediction,
+    update_flooding_api_data,
+    upload_image_to_gcs,
+)
+from pipelines.deteccao_alagamento_cameras.flooding_detection.utils import (
+    FloodingDataPublisher,
+    GeminiClassifier,
+    PredictionQueue,
+    get_sheet_cache_key,
+    redis_set_cached_sheet,
+)
+
+CAMERAS_SHEET_URL = "https://benchmark/cameras/edit#gid=0"
+OBJECT_PARAMETERS_SHEET_URL = "https://benchmark/object_parameters/edit#gid=0"
+OBJECTS = ["alagamento", "bolsao", "transito"]
+
+
+class FakeResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeGenerativeModel:
+    """
+    Stands in for `genai.GenerativeModel`, answering after a random delay around `latency`
+    seconds and failing with a retryable error at `error_rate`.
+    """
+
+    def __init__(self, latency: float = 1.0, error_rate: float = 0.0, positive_rate: float = 0.1):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.positive_rate = positive_rate
+
+    async def generate_content_async(self, contents: List[Any], generation_config: Dict):
+        await asyncio.sleep(random.lognormvariate(0, 0.25) * self.latency)
+        if random.random() < self.error_rate:
+            raise google_exceptions.ServiceUnavailable("Fake classifier error.")
+        label = random.random() < self.positive_rate
+        return FakeResponse(json.dumps({"label": label}))
+
+
+class FakeGeminiClassifier(GeminiClassifier):
+    """
+    A `GeminiClassifier` backed by a `FakeGenerativeModel`, recording the latency of each
+    classification, including the time waiting for the rate limiter and retries.
+    """
+
+    def __init__(
+        self,
+        latency: float = 1.0,
+        error_rate: float = 0.0,
+        positive_rate: float = 0.1,
+        **kwargs,
+    ):
+        # Every camera streams the same video, so memoization (no Redis client) is left off,
+        # as it would answer almost everything
+        super().__init__(
+            api_key=None,
+            model_name="fake",
+            model=FakeGenerativeModel(
+                latency=latency, error_rate=error_rate, positive_rate=positive_rate
+            ),
+            **kwargs,
+        )
+        self.latencies = []
+
+    async def classify(self, *args, **kwargs) -> bool:
+        start_time = time.perf_counter()
+        try:
+            return await super().classify(*args, **kwargs)
+        finally:
+            self.latencies.append(time.perf_counter() - start_time)
+
+
+class FakeBlob:
+    def __init__(self, bucket: "FakeBucket", name: str):
+        self.bucket = bucket
+        self.name = name
+
+    @property
+    def public_url(self) -> str:
+        return f"https://storage.googleapis.com/{self.bucket.name}/{self.name}"
+
+    def upload_from_string(self, data: bytes, content_type: str = None, if_generation_match=None):
+        if if_generation_match == 0 and self.name in self.bucket.blobs:
+            raise google_exceptions.PreconditionFailed(f"{self.name} already exists.")
+        self.bucket.blobs[self.name] = len(data)
+
+
+class FakeBucket:
+    def __init__(self, name: str):
+        self.name = name
+        self.blobs = {}
+
+    def blob(self, name: str) -> FakeBlob:
+        return FakeBlob(self, name)
+
+    def copy_blob(self, blob: FakeBlob, destination_bucket: "FakeBucket", new_name: str):
+        destination_bucket.blobs[new_name] = self.blobs[blob.name]
+        return FakeBlob(destination_bucket, new_name)
+
+
+class FakeStorageClient:
+    """
+    Stands in for `storage.Client`, keeping only the size of each uploaded blob.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+
+    def bucket(self, name: str) -> FakeBucket:
+        return self.buckets.setdefault(name, FakeBucket(name))
+
+
+def get_fake_redis_client() -> RedisPal:
+    """
+    Gets a `RedisPal` client backed by an in-process fakeredis server.
+    """
+    try:
+        import fakeredis
+    except ImportError:
+        raise ImportError("The benchmark needs fakeredis, or a Redis server with --redis-url.")
+    return RedisPal(
+        connection_pool=redis.ConnectionPool(
+            connection_class=fakeredis.FakeConnection, server=fakeredis.FakeServer()
+        )
+    )
+
+
+def write_sample_video(path: Path, width: int = 1280, height: int = 720, frames: int = 30):
+    """
+    Writes a short synthetic video, used when no `--video` is given.
+    """
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"mp4v"), 15, (width, height))
+    base = cv2.GaussianBlur(
+        np.random.randint(0, 255, (height, width, 3), dtype=np.uint8), (31, 31), 0
+    )
+    for index in range(frames):
+        writer.write(np.roll(base, index * 8, axis=1))
+    writer.release()
+
+
+def seed_sheets(
+    redis_client: RedisPal, sheet_cache_key: str, number_cameras: int, video_path: str
+) -> None:
+    """
+    Caches synthetic cameras and object parameters sheets, so `pick_cameras` reads them
+    instead of downloading the real ones.
+    """
+    cameras = pd.DataFrame(
+        {
+            "id_camera": [str(index).zfill(6) for index in range(1, number_cameras + 1)],
+            "nome": [f"Benchmark camera {index}" for index in range(1, number_cameras + 1)],
+            "rtsp": video_path,
+            "latitude": np.random.uniform(-23.0, -22.8, number_cameras),
+            "longitude": np.random.uniform(-43.6, -43.2, number_cameras),
+            "identificador": [
+                ",".join(random.sample(OBJECTS, random.randint(1, 2)))
+                for _ in range(number_cameras)
+            ],
+        }
+    )
+    object_parameters = pd.DataFrame(
+        {
+            "objeto": OBJECTS,
+            "prompt": [f"Is there {object_name} in the image?" for object_name in OBJECTS],
+            "max_output_token": 300,
+            "temperature": 0.4,
+            "top_k": 1,
+            "top_p": 32,
+        }
+    )
+    for url, dataframe in [
+        (CAMERAS_SHEET_URL, cameras),
+        (OBJECT_PARAMETERS_SHEET_URL, object_parameters),
+    ]:
+        redis_set_cached_sheet(
+            dataframe,
+            redis_client=redis_client,
+            key=get_sheet_cache_key(url, cache_key=sheet_cache_key),
+        )
+
+
+def timed(samples: List[float], function: Callable) -> Callable:
+    def wrapper(*args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            samples.append(time.perf_counter() - start_time)
+
+    return wrapper
+
+
+def get_peak_memory() -> Dict[str, float]:
+    """
+    Gets the peak resident memory of this process and of its largest capture subprocess,
+    in MB. Both only grow, so runs are made in increasing number of cameras.
+    """
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+def run_cycle(
+    number_cameras: int,
+    parameters: Dict[str, Any],
+    redis_client: RedisPal,
+    video_path: str,
+    classifier: FakeGeminiClassifier,
+    storage_client: FakeStorageClient,
+    max_workers: int = 100,
+) -> Dict[str, Any]:
+    """
+    Runs one flooding detection cycle over `number_cameras` cameras.
+
+    Returns:
+        The cycle time, the throughput, the wall time and p50/p95 item latency of each stage,
+        in seconds, and the peak memory.
+    """
+    p = parameters
+    seed_sheets(redis_client, p["redis_key_sheet_cache"], number_cameras, video_path)
+    samples = {
+        stage: []
+        for stage in [
+            "pick_cameras",
+            "get_snapshot",
+            "upload_image_to_gcs",
+            "prefilter_snapshot",
+            "classify",
+            "update_flooding_api_data",
+        ]
+    }
+    wall_times = {}
+    classifier.latencies = samples["classify"]
+
+    def run_stage(stage: str, function: Callable, *args, **kwargs):
+        start_time = time.perf_counter()
+        result = timed(samples[stage], function)(*args, **kwargs)
+        wall_times[stage] = time.perf_counter() - start_time
+        return result
+
+    def map_stage(stage: str, function: Callable, cameras: List, **kwargs):
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            result = list(executor.map(timed(samples[stage], partial(function, **kwargs)), cameras))
+        wall_times[stage] = time.perf_counter() - start_time
+        return result
+
+    start_time = time.perf_counter()
+    cameras = run_stage(
+        "pick_cameras",
+        pick_cameras.run,
+        rain_api_data_url=p["rain_api_url"],
+        cameras_data_url=CAMERAS_SHEET_URL,
+        object_parameters_url=OBJECT_PARAMETERS_SHEET_URL,
+        last_update=None,
+        predictions_buffer_key=p["redis_key_predictions_buffer"],
+        redis_client=redis_client,
+        use_rain_api_data=False,
+        sheet_cache_key=p["redis_key_sheet_cache"],
+        sheet_cache_ttl=float("inf"),
+        last_check_key=p["redis_key_last_check"],
+        health_key=p["redis_key_camera_health"],
+    )
+    publisher = FloodingDataPublisher(
+        redis_client=redis_client,
+        data_key=p["redis_key_flooding_detection_data"],
+        last_update_key=p["redis_key_flooding_detection_last_update"],
+        predictions_buffer_key=p["redis_key_predictions_buffer"],
+        id_cameras=[camera.id_camera for camera in cameras],
+        min_interval=p["publish_interval"],
+    )
+    prediction_queue = PredictionQueue(
+        classifier,
+        on_prediction=publisher.publish,
+        multi_object_prediction=False,
+        redis_client=redis_client,
+        prediction_cache_key=p["redis_key_prediction_cache"],
+        prediction_cache_max_distance=p["prediction_cache_max_distance"],
+        prediction_cache_ttl=p["prediction_cache_ttl"],
+    )
+    cameras = map_stage(
+        "get_snapshot",
+        get_snapshot.run,
+        cameras,
+        resize_width=p["resize_width"],
+        resize_height=p["resize_height"],
+        snapshot_timeout=p["snapshot_timeout"],
+        use_stream_pool=False,
+        max_concurrent_captures=p["max_concurrent_captures"],
+        snapshot_format=p["snapshot_format"],
+        snapshot_quality=p["snapshot_quality"],
+        capture_backend=p["capture_backend"],
+        redis_client=redis_client,
+        health_key=p["redis_key_camera_health"],
+    )
+    cameras = map_stage(
+        "upload_image_to_gcs",
+        upload_image_to_gcs.run,
+        cameras,
+        bucket_name=p["image_upload_bucket"],
+        blob_base_path=p["image_upload_blob_prefix"],
+        archive_blob_base_path=p["image_archive_blob_prefix"],
+        storage_client=storage_client,
+    )
+    cameras = map_stage(
+        "prefilter_snapshot",
+        prefilter_snapshot.run,
+        cameras,
+        redis_client=redis_client,
+        prefilter_key=p["redis_key_prefilter"],
+    )
+    predict_start_time = time.perf_counter()
+    for camera in cameras:
+        submit_prediction.run(camera, prediction_queue=prediction_queue)
+    cameras = get_predictions.run(cameras, prediction_queue=prediction_queue)
+    wall_times["classify"] = time.perf_counter() - predict_start_time
+    run_stage(
+        "update_flooding_api_data",
+        update_flooding_api_data.run,
+        cameras_with_image_and_classification=cameras,
+        data_key=p["redis_key_flooding_detection_data"],
+        last_update_key=p["redis_key_flooding_detection_last_update"],
+        predictions_buffer_key=p["redis_key_predictions_buffer"],
+        redis_client=redis_client,
+        publisher=publisher,
+    )
+    cycle_time = time.perf_counter() - start_time
+
+    return {
+        "cameras": number_cameras,
+        "snapshots": sum(camera.snapshot is not None for camera in cameras),
+        "cycle_time": cycle_time,
+        "throughput": number_cameras / cycle_time,
+        "stages": {
+            stage: {
+                "wall": wall_times.get(stage),
+                "count": len(stage_samples),
+                "p50": float(np.percentile(stage_samples, 50)) if stage_samples else None,
+                "p95": float(np.percentile(stage_samples, 95)) if stage_samples else None,
+            }
+            for stage, stage_samples in samples.items()
+        },
+        "peak_memory_mb": get_peak_memory(),
+    }
+
+
+def format_report(result: Dict[str, Any]) -> str:
+    lines = [
+        f"{result['cameras']} cameras ({result['snapshots']} snapshots): "
+        f"{result['cycle_time']:.2f}s, {result['throughput']:.1f} cameras/s, "
+        f"peak RSS {result['peak_memory_mb']['self']:.0f} MB "
+        f"(captures {result['peak_memory_mb']['children']:.0f} MB)",
+        f"    {'stage':<26}{'wall (s)':>10}{'count':>8}{'p50 (ms)':>10}{'p95 (ms)':>10}",
+    ]
+    for stage, stats in result["stages"].items():
+        if not stats["count"]:
+            continue
+        lines.append(
+            f"    {stage:<26}{stats['wall']:>10.2f}{stats['count']:>8}"
+            f"{stats['p50'] * 1000:>10.1f}{stats['p95'] * 1000:>10.1f}"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks a flooding detection cycle offline.")
+    parser.add_argument("--cameras", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--video", help="Video file streamed by every camera.")
+    parser.add_argument("--redis-url", help="Redis server to use instead of fakeredis.")
+    parser.add_argument("--classifier-latency", type=float, default=1.0)
+    parser.add_argument("--classifier-error-rate", type=float, default=0.0)
+    parser.add_argument("--requests-per-minute", type=float, default=6000)
+    parser.add_argument("--max-concurrent-requests", type=int, default=20)
+    parser.add_argument("--max-workers", type=int, default=100)
+    parser.add_argument("--json", help="Writes the results to this file.")
+    args = parser.parse_args()
+
+    # Every key of the benchmark is namespaced, so a real Redis server is left untouched
+    key_prefix = f"flooding_detection_benchmark:{int(time.time())}:"
+    parameters = get_default_parameters()
+    parameters.update(
+        {
+            name: f"{key_prefix}{value}"
+            for name, value in parameters.items()
+            if name.startswith("redis_key_")
+        }
+    )
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        video_path = args.video
+        if video_path is None:
+            video_path = str(Path(tmp_dir) / "sample.mp4")
+            write_sample_video(Path(video_path))
+        for number_cameras in sorted(args.cameras):
+            redis_client = (
+                RedisPal.from_url(args.redis_url) if args.redis_url else get_fake_redis_client()
+            )
+            classifier = FakeGeminiClassifier(
+                latency=args.classifier_latency,
+                error_rate=args.classifier_error_rate,
+                requests_per_minute=args.requests_per_minute,
+                max_concurrency=args.max_concurrent_requests,
+            )
+            result = run_cycle(
+                number_cameras,
+                parameters=parameters,
+                redis_client=redis_client,
+                video_path=video_path,
+                classifier=classifier,
+                storage_client=FakeStorageClient(),
+                max_workers=args.max_workers,
+            )
+            print(format_report(result))
+            results.append(result)
+            if args.redis_url:
+                for key in redis_client.scan_iter(match=f"{key_prefix}*"):
+                    redis_client.delete(key)
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
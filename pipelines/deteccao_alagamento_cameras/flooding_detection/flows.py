@@ -15,12 +15,21 @@ from pipelines.deteccao_alagamento_cameras.flooding_detection.schedules import (
     update_flooding_data_schedule,
 )
 from pipelines.deteccao_alagamento_cameras.flooding_detection.tasks import (
-    api_data_to_csv,
+    ack_spooled_api_data,
+    api_data_to_parquet,
+    export_stage_metrics,
     get_api_key,
+    get_cycle_deadline,
+    get_flooding_data_publisher,
     get_last_update,
-    get_prediction,
+    get_prediction_queue,
+    get_predictions,
     get_snapshot,
+    get_spooled_api_data,
     pick_cameras,
+    prefilter_snapshot,
+    spool_api_data,
+    submit_prediction,
     task_get_redis_client,
     update_flooding_api_data,
     upload_image_to_gcs,
@@ -44,6 +53,9 @@ with Flow(
         default=0,
     )
     google_api_model = Parameter("google_api_model", default="gemini-pro-vision")
+    multi_object_prediction = Parameter("multi_object_prediction", default=False)
+    google_api_requests_per_minute = Parameter("google_api_requests_per_minute", default=60)
+    google_api_max_concurrent_requests = Parameter("google_api_max_concurrent_requests", default=20)
     api_key_secret_path = Parameter(
         "api_key_secret_path", required=True, default="/flooding-detection"
     )
@@ -52,6 +64,21 @@ with Flow(
         required=True,
         default="https://docs.google.com/spreadsheets/d/122uOaPr8YdW5PTzrxSPF-FD0tgco596HqgB7WK7cHFw/edit#gid=1580662721",  # noqa
     )
+    redis_key_sheet_cache = Parameter(
+        "redis_key_sheet_cache", default="flooding_detection_sheet_cache"
+    )
+    sheet_cache_ttl = Parameter("sheet_cache_ttl", default=600)
+    redis_key_last_check = Parameter(
+        "redis_key_last_check", default="flooding_detection_last_check"
+    )
+    cameras_budget = Parameter("cameras_budget", default=0)
+    camera_revisit_interval = Parameter("camera_revisit_interval", default=1800)
+    redis_key_camera_health = Parameter(
+        "redis_key_camera_health", default="flooding_detection_camera_health"
+    )
+    circuit_failure_threshold = Parameter("circuit_failure_threshold", default=3)
+    circuit_backoff_base = Parameter("circuit_backoff_base", default=300)
+    circuit_backoff_max = Parameter("circuit_backoff_max", default=3600)
     use_rain_api_data = Parameter(
         "use_rain_api_data",
         default=False,
@@ -74,9 +101,28 @@ with Flow(
         "redis_key_flooding_detection_last_update",
         default="flooding_detection_last_update",
     )
+    redis_key_prediction_cache = Parameter(
+        "redis_key_prediction_cache", default="flooding_detection_prediction_cache"
+    )
+    redis_key_prefilter = Parameter("redis_key_prefilter", default="flooding_detection_prefilter")
+    # Reuses labels of nearly identical frames, set to -1 to always call the model
+    prediction_cache_max_distance = Parameter("prediction_cache_max_distance", default=4)
+    prediction_cache_ttl = Parameter("prediction_cache_ttl", default=900)
+    redis_key_prediction_memo = Parameter(
+        "redis_key_prediction_memo", default="flooding_detection_prediction_memo"
+    )
+    prediction_memo_ttl = Parameter("prediction_memo_ttl", default=900)
     resize_width = Parameter("resize_width", default=640)
     resize_height = Parameter("resize_height", default=480)
-    snapshot_timeout = Parameter("snapshot_timeout", default=300)
+    snapshot_timeout = Parameter("snapshot_timeout", default=15)
+    snapshot_format = Parameter("snapshot_format", default="jpeg")
+    snapshot_quality = Parameter("snapshot_quality", default=75)
+    use_stream_pool = Parameter("use_stream_pool", default=False)
+    capture_backend = Parameter("capture_backend", default="ffmpeg")
+    max_concurrent_captures = Parameter("max_concurrent_captures", default=20)
+    capture_timeout = Parameter("capture_timeout", default=120)
+    cycle_timeout = Parameter("cycle_timeout", default=170)
+    publish_interval = Parameter("publish_interval", default=5)
 
     image_upload_bucket = Parameter(
         "image_upload_bucket",
@@ -86,6 +132,19 @@ with Flow(
         "image_upload_blob_prefix",
         default="flooding_detection/latest_snapshots",
     )
+    image_archive_blob_prefix = Parameter(
+        "image_archive_blob_prefix",
+        default="flooding_detection/snapshots",
+    )
+    redis_key_api_data_spool = Parameter(
+        "redis_key_api_data_spool", default="flooding_detection_api_data_spool"
+    )
+    api_data_flush_interval = Parameter("api_data_flush_interval", default=900)
+    api_data_flush_rows = Parameter("api_data_flush_rows", default=5000)
+    redis_key_stage_metrics = Parameter(
+        "redis_key_stage_metrics", default="flooding_detection_stage_metrics"
+    )
+    metrics_textfile_path = Parameter("metrics_textfile_path", default=None)
     dataset_id = Parameter("dataset_id", default="ai_vision_detection")
     table_id = Parameter("table_id", default="cameras_predicoes")
 
@@ -107,38 +166,107 @@ with Flow(
         redis_client=redis_client,
         number_mock_rain_cameras=mocked_cameras_number,
         use_rain_api_data=use_rain_api_data,
+        sheet_cache_key=redis_key_sheet_cache,
+        sheet_cache_ttl=sheet_cache_ttl,
+        last_check_key=redis_key_last_check,
+        cameras_budget=cameras_budget,
+        revisit_interval=camera_revisit_interval,
+        health_key=redis_key_camera_health,
+    )
+    capture_deadline = get_cycle_deadline(timeout=capture_timeout)
+    cycle_deadline = get_cycle_deadline(timeout=cycle_timeout)
+    publisher = get_flooding_data_publisher(
+        cameras=cameras,
+        data_key=redis_key_flooding_detection_data,
+        last_update_key=redis_key_flooding_detection_last_update,
+        predictions_buffer_key=redis_key_predictions_buffer,
+        redis_client=redis_client,
+        publish_interval=publish_interval,
     )
     api_key = get_api_key(secret_path=api_key_secret_path, secret_name="GEMINI-PRO-VISION-API-KEY")
+    prediction_queue = get_prediction_queue(
+        google_api_key=api_key,
+        google_api_model=google_api_model,
+        multi_object_prediction=multi_object_prediction,
+        redis_client=redis_client,
+        prediction_cache_key=redis_key_prediction_cache,
+        prediction_cache_max_distance=prediction_cache_max_distance,
+        prediction_cache_ttl=prediction_cache_ttl,
+        requests_per_minute=google_api_requests_per_minute,
+        max_concurrent_requests=google_api_max_concurrent_requests,
+        publisher=publisher,
+        prediction_memo_key=redis_key_prediction_memo,
+        prediction_memo_ttl=prediction_memo_ttl,
+    )
     cameras_with_image = get_snapshot.map(
         camera=cameras,
         resize_width=unmapped(resize_width),
         resize_height=unmapped(resize_height),
         snapshot_timeout=unmapped(snapshot_timeout),
+        use_stream_pool=unmapped(use_stream_pool),
+        max_concurrent_captures=unmapped(max_concurrent_captures),
+        deadline=unmapped(capture_deadline),
+        snapshot_format=unmapped(snapshot_format),
+        snapshot_quality=unmapped(snapshot_quality),
+        capture_backend=unmapped(capture_backend),
+        redis_client=unmapped(redis_client),
+        health_key=unmapped(redis_key_camera_health),
+        circuit_failure_threshold=unmapped(circuit_failure_threshold),
+        circuit_backoff_base=unmapped(circuit_backoff_base),
+        circuit_backoff_max=unmapped(circuit_backoff_max),
     )
 
     cameras_with_image_url = upload_image_to_gcs.map(
         camera_with_image=cameras_with_image,
         bucket_name=unmapped(image_upload_bucket),
         blob_base_path=unmapped(image_upload_blob_prefix),
+        archive_blob_base_path=unmapped(image_archive_blob_prefix),
     )
 
-    cameras_with_image_and_classification = get_prediction.map(
+    cameras_prefiltered = prefilter_snapshot.map(
         camera_with_image=cameras_with_image_url,
-        google_api_key=unmapped(api_key),
-        google_api_model=unmapped(google_api_model),
+        redis_client=unmapped(redis_client),
+        prefilter_key=unmapped(redis_key_prefilter),
     )
 
-    api_data, has_api_data = update_flooding_api_data(
+    # Each camera is classified as soon as its snapshot is pre-filtered
+    cameras_submitted = submit_prediction.map(
+        camera_with_image=cameras_prefiltered,
+        prediction_queue=unmapped(prediction_queue),
+    )
+
+    cameras_with_image_and_classification = get_predictions(
+        cameras_with_image=cameras_submitted,
+        prediction_queue=prediction_queue,
+        deadline=cycle_deadline,
+    )
+
+    api_data, _ = update_flooding_api_data(
         cameras_with_image_and_classification=cameras_with_image_and_classification,
         data_key=redis_key_flooding_detection_data,
         last_update_key=redis_key_flooding_detection_last_update,
         predictions_buffer_key=redis_key_predictions_buffer,
         redis_client=redis_client,
+        publisher=publisher,
+    )
+
+    spooled_api_data = spool_api_data(
+        api_data=api_data,
+        api_model=google_api_model,
+        redis_client=redis_client,
+        spool_key=redis_key_api_data_spool,
+    )
+    spooled_data, batch_id, should_load_batch = get_spooled_api_data(
+        redis_client=redis_client,
+        spool_key=redis_key_api_data_spool,
+        flush_interval=api_data_flush_interval,
+        flush_rows=api_data_flush_rows,
+        wait=spooled_api_data,
     )
 
-    with case(has_api_data, True):
-        data_path, dataframe = api_data_to_csv(
-            data_path="/tmp/api_data_cameras/", api_data=api_data, api_model=google_api_model
+    with case(should_load_batch, True):
+        data_path = api_data_to_parquet(
+            data_path="/tmp/api_data_cameras/", dataframe=spooled_data, batch_id=batch_id
         )
 
         create_staging_table = create_table_and_upload_to_gcs(
@@ -147,14 +275,29 @@ with Flow(
             table_id=table_id,
             biglake_table=True,
             dump_mode="append",
+            source_format="parquet",
         )
         create_staging_table.set_upstream(data_path)
 
         update_native_table = upload_to_native_table(
-            dataset_id=dataset_id, table_id=table_id, dataframe=dataframe
+            dataset_id=dataset_id, table_id=table_id, dataframe=spooled_data
         )
         update_native_table.set_upstream(create_staging_table)
 
+        acknowledged_batch = ack_spooled_api_data(
+            redis_client=redis_client,
+            spool_key=redis_key_api_data_spool,
+            wait=update_native_table,
+        )
+
+    exported_metrics = export_stage_metrics(
+        redis_client=redis_client,
+        metrics_key=redis_key_stage_metrics,
+        textfile_path=metrics_textfile_path,
+    )
+    exported_metrics.set_upstream(spooled_data)
+    exported_metrics.set_upstream(acknowledged_batch)
+
 
 rj_escritorio__flooding_detection__flow.storage = GCS(constants.GCS_FLOWS_BUCKET.value)
 rj_escritorio__flooding_detection__flow.run_config = KubernetesRun(
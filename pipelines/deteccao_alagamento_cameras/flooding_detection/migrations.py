@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+One-off migration of the flooding detection tables to the Parquet staging data.
+
+The staging BigLake table was created over CSV files, and the flow now writes Parquet
+partitions under the same GCS prefix, which the CSV table can't read. This moves the CSV
+files to a backup prefix and drops the staging table, so that the next flow run recreates
+it over the Parquet files. The rows of the CSV files are already in the native table. It
+also changes `top_p` from INT64 to FLOAT64 in the native table, and in any other table
+given (e.g. the dbt model's, if it is materialized elsewhere), as it is now loaded as a
+float. Running it again is a no-op. Pause the flow schedule, deploy, run this and then
+resume the schedule.
+
+Usage:
+    python -m pipelines.deteccao_alagamento_cameras.flooding_detection.migrations \\
+        --dataset-id ai_vision_detection --table-id cameras_predicoes
+"""
+
+import argparse
+from typing import List
+
+import basedosdados as bd
+from prefect.engine.state import Running
+from prefeitura_rio.pipelines_utils.logging import log
+from prefeitura_rio.pipelines_utils.state_handlers import handler_inject_bd_credentials
+
+
+def move_csv_staging_files(dataset_id: str, table_id: str, backup_prefix: str) -> int:
+    """
+    Moves the CSV files of the staging table to `{backup_prefix}/{dataset_id}/{table_id}/`,
+    keeping their partition paths.
+
+    Returns:
+        The number of files moved.
+    """
+    bucket = bd.Storage(dataset_id=dataset_id, table_id=table_id).bucket
+    prefix = f"staging/{dataset_id}/{table_id}/"
+    moved = 0
+    for blob in bucket.list_blobs(prefix=prefix):
+        if not blob.name.endswith(".csv"):
+            continue
+        new_name = f"{backup_prefix}/{dataset_id}/{table_id}/{blob.name[len(prefix):]}"
+        bucket.rename_blob(blob, new_name)
+        moved += 1
+    log(f"Moved {moved} CSV files from gs://{bucket.name}/{prefix}.")
+    return moved
+
+
+def widen_top_p(client, table_names: List[str]) -> None:
+    """
+    Changes the `top_p` column of each table from INT64 to FLOAT64, if it is still INT64.
+    """
+    for table_name in table_names:
+        table = client.get_table(table_name)
+        field = next((field for field in table.schema if field.name == "top_p"), None)
+        if field is None or field.field_type not in ("INTEGER", "INT64"):
+            continue
+        client.query(
+            f"ALTER TABLE `{table_name}` ALTER COLUMN top_p SET DATA TYPE FLOAT64"
+        ).result()
+        log(f"Changed top_p to FLOAT64 in {table_name}.")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Migrates the flooding detection tables to the Parquet staging data."
+    )
+    parser.add_argument("--dataset-id", default="ai_vision_detection")
+    parser.add_argument("--table-id", default="cameras_predicoes")
+    parser.add_argument(
+        "--backup-prefix",
+        default="staging_csv_backup",
+        help="GCS prefix, in the staging bucket, the CSV files are moved to.",
+    )
+    parser.add_argument(
+        "--widen-table",
+        action="append",
+        default=[],
+        metavar="PROJECT.DATASET.TABLE",
+        help="Another table whose top_p column is changed to FLOAT64.",
+    )
+    args = parser.parse_args()
+
+    handler_inject_bd_credentials(None, None, Running())
+    table = bd.Table(dataset_id=args.dataset_id, table_id=args.table_id)
+
+    move_csv_staging_files(args.dataset_id, args.table_id, backup_prefix=args.backup_prefix)
+    table.delete(mode="staging")
+    log(f"Dropped {table.table_full_name['staging']}, the next flow run recreates it.")
+
+    widen_top_p(table.client["bigquery_prod"], [table.table_full_name["prod"]] + args.widen_table)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+"""
+Long-running alternative to the flooding detection flow.
+
+Runs the same stages as `rj_escritorio__flooding_detection__flow` (pick cameras, snapshot,
+upload, pre-filter, predict, publish and BigQuery upload) as an asyncio service that
+schedules its own cycles, so the Redis client, the secrets and the classifier rate limiter
+are reused across cycles, as are the open camera streams with `use_stream_pool=true`. Each
+camera goes through the stages on its own and is published as soon as it is classified.
+The Redis keys are the same as the flow's, so the API is unchanged. The flow schedule must
+be turned off while the service runs.
+
+Usage:
+    python -m pipelines.deteccao_alagamento_cameras.flooding_detection.service \\
+        --interval 180 --parameter cameras_budget=200
+"""
+import argparse
+import asyncio
+import json
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict, List
+
+from prefect.engine.state import Running
+from prefeitura_rio.pipelines_utils.logging import log
+from prefeitura_rio.pipelines_utils.state_handlers import handler_inject_bd_credentials
+from prefeitura_rio.pipelines_utils.tasks import create_table_and_upload_to_gcs
+
+from pipelines.deteccao_alagamento_cameras.flooding_detection.flows import (
+    rj_escritorio__flooding_detection__flow,
+)
+from pipelines.deteccao_alagamento_cameras.flooding_detection.schedules import (
+    update_flooding_data_schedule,
+)
+from pipelines.deteccao_alagamento_cameras.flooding_detection.tasks import (
+    ack_spooled_api_data,
+    api_data_to_parquet,
+    export_stage_metrics,
+    get_api_key,
+    get_last_update,
+    get_snapshot,
+    get_spooled_api_data,
+    pick_cameras,
+    prefilter_snapshot,
+    spool_api_data,
+    task_get_redis_client,
+    update_flooding_api_data,
+    upload_image_to_gcs,
+    upload_to_native_table,
+)
+from pipelines.deteccao_alagamento_cameras.flooding_detection.utils import (
+    CameraRecord,
+    FloodingDataPublisher,
+    GeminiClassifier,
+    predict_camera,
+)
+
+# The stream pool keeps a connection and a decoder open per camera, so it is opt-in
+# (`--parameter use_stream_pool=true`, for "opencv" cameras) on hosts sized for them
+SERVICE_PARAMETER_DEFAULTS = {"use_stream_pool": False}
+
+
+def get_default_parameters() -> Dict[str, Any]:
+    """
+    Gets the parameters of a scheduled flow run: the flow defaults overridden by the
+    schedule defaults.
+    """
+    parameters = {
+        parameter.name: parameter.default
+        for parameter in rj_escritorio__flooding_detection__flow.parameters()
+    }
+    for clock in update_flooding_data_schedule.clocks:
+        parameters.update(clock.parameter_defaults)
+    parameters.update(SERVICE_PARAMETER_DEFAULTS)
+    return parameters
+
+
+class FloodingDetectionService:
+    """
+    Runs a flooding detection cycle every `interval` seconds until stopped.
+
+    Args:
+        parameters: The flow parameters, see `get_default_parameters`.
+        interval: Number of seconds between the start of two cycles.
+        max_workers: Number of threads for the blocking stages (captures, uploads, Redis).
+    """
+
+    def __init__(self, parameters: Dict[str, Any], interval: float = 180, max_workers: int = 100):
+        self.parameters = parameters
+        self.interval = interval
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.redis_client = None
+        self.classifier = None
+        self._stop = asyncio.Event()
+
+    async def _run(self, function: Callable, *args, **kwargs) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, partial(function, *args, **kwargs)
+        )
+
+    def stop(self):
+        log("Stopping flooding detection service after the current cycle.")
+        self._stop.set()
+
+    async def setup(self):
+        """
+        Injects the BigQuery credentials and creates the clients shared by all cycles.
+        """
+        p = self.parameters
+        handler_inject_bd_credentials(None, None, Running())
+        self.redis_client = await self._run(
+            task_get_redis_client.run,
+            infisical_host_env="REDIS_HOST",
+            infisical_port_env="REDIS_PORT",
+            infisical_db_env="REDIS_DB",
+            infisical_password_env="REDIS_PASSWORD",
+            infisical_secrets_path=p["api_key_secret_path"],
+        )
+        api_key = await self._run(
+            get_api_key.run,
+            secret_path=p["api_key_secret_path"],
+            secret_name="GEMINI-PRO-VISION-API-KEY",
+        )
+        self.classifier = GeminiClassifier(
+            api_key=api_key,
+            model_name=p["google_api_model"],
+            requests_per_minute=p["google_api_requests_per_minute"],
+            max_concurrency=p["google_api_max_concurrent_requests"],
+            redis_client=self.redis_client,
+            memo_key=p["redis_key_prediction_memo"],
+            memo_ttl=p["prediction_memo_ttl"],
+        )
+
+    async def process_camera(
+        self,
+        camera: CameraRecord,
+        publisher: FloodingDataPublisher,
+        capture_deadline: float,
+    ) -> CameraRecord:
+        """
+        Takes a camera through snapshot, upload, pre-filter and prediction, then publishes it.
+        """
+        p = self.parameters
+        camera = await self._run(
+            get_snapshot.run,
+            camera=camera,
+            resize_width=p["resize_width"],
+            resize_height=p["resize_height"],
+            snapshot_timeout=p["snapshot_timeout"],
+            use_stream_pool=p["use_stream_pool"],
+            max_concurrent_captures=p["max_concurrent_captures"],
+            deadline=capture_deadline,
+            snapshot_format=p["snapshot_format"],
+            snapshot_quality=p["snapshot_quality"],
+            capture_backend=p["capture_backend"],
+            redis_client=self.redis_client,
+            health_key=p["redis_key_camera_health"],
+            circuit_failure_threshold=p["circuit_failure_threshold"],
+            circuit_backoff_base=p["circuit_backoff_base"],
+            circuit_backoff_max=p["circuit_backoff_max"],
+        )
+        camera = await self._run(
+            upload_image_to_gcs.run,
+            camera_with_image=camera,
+            bucket_name=p["image_upload_bucket"],
+            blob_base_path=p["image_upload_blob_prefix"],
+            archive_blob_base_path=p["image_archive_blob_prefix"],
+        )
+        camera = await self._run(
+            prefilter_snapshot.run,
+            camera_with_image=camera,
+            redis_client=self.redis_client,
+            prefilter_key=p["redis_key_prefilter"],
+        )
+        camera = await predict_camera(
+            camera,
+            self.classifier,
+            multi_object_prediction=p["multi_object_prediction"],
+            redis_client=self.redis_client,
+            prediction_cache_key=p["redis_key_prediction_cache"],
+            prediction_cache_max_distance=p["prediction_cache_max_distance"],
+            prediction_cache_ttl=p["prediction_cache_ttl"],
+        )
+        await self._run(publisher.publish, [camera])
+        return camera
+
+    async def run_cycle(self):
+        """
+        Runs a single flooding detection cycle.
+        """
+        p = self.parameters
+        start_time = time.time()
+        capture_deadline = start_time + p["capture_timeout"]
+        cycle_deadline = start_time + p["cycle_timeout"]
+
+        last_update = await self._run(
+            get_last_update.run, rain_api_update_url=p["rain_api_update_url"]
+        )
+        cameras: List[CameraRecord] = await self._run(
+            pick_cameras.run,
+            rain_api_data_url=p["rain_api_url"],
+            cameras_data_url=p["cameras_geodf_url"],
+            object_parameters_url=p["object_parameters_url"],
+            last_update=last_update,
+            predictions_buffer_key=p["redis_key_predictions_buffer"],
+            redis_client=self.redis_client,
+            number_mock_rain_cameras=p["mocked_cameras_number"],
+            use_rain_api_data=p["use_rain_api_data"],
+            sheet_cache_key=p["redis_key_sheet_cache"],
+            sheet_cache_ttl=p["sheet_cache_ttl"],
+            last_check_key=p["redis_key_last_check"],
+            cameras_budget=p["cameras_budget"],
+            revisit_interval=p["camera_revisit_interval"],
+            health_key=p["redis_key_camera_health"],
+        )
+        publisher = FloodingDataPublisher(
+            redis_client=self.redis_client,
+            data_key=p["redis_key_flooding_detection_data"],
+            last_update_key=p["redis_key_flooding_detection_last_update"],
+            predictions_buffer_key=p["redis_key_predictions_buffer"],
+            id_cameras=[camera.id_camera for camera in cameras],
+            min_interval=p["publish_interval"],
+        )
+
+        tasks = {
+            asyncio.ensure_future(self.process_camera(camera, publisher, capture_deadline)): camera
+            for camera in cameras
+        }
+        if tasks:
+            done, pending = await asyncio.wait(tasks, timeout=max(cycle_deadline - time.time(), 0))
+            for task in pending:
+                task.cancel()
+            for task in done:
+                if task.exception() is not None:
+                    log(
+                        f"Failed to process camera {tasks[task].id_camera}: {task.exception()}",
+                        level="warning",
+                    )
+            for task in pending | {task for task in done if task.exception() is not None}:
+                tasks[task].attempt_classification = False
+            if pending:
+                log(f"Dropped {len(pending)} cameras at the cycle deadline.", level="warning")
+
+        bq_data, _ = await self._run(
+            update_flooding_api_data.run,
+            cameras_with_image_and_classification=cameras,
+            data_key=p["redis_key_flooding_detection_data"],
+            last_update_key=p["redis_key_flooding_detection_last_update"],
+            predictions_buffer_key=p["redis_key_predictions_buffer"],
+            redis_client=self.redis_client,
+            publisher=publisher,
+        )
+        await self._run(
+            spool_api_data.run,
+            api_data=bq_data,
+            api_model=p["google_api_model"],
+            redis_client=self.redis_client,
+            spool_key=p["redis_key_api_data_spool"],
+        )
+        spooled_data, batch_id, should_load_batch = await self._run(
+            get_spooled_api_data.run,
+            redis_client=self.redis_client,
+            spool_key=p["redis_key_api_data_spool"],
+            flush_interval=p["api_data_flush_interval"],
+            flush_rows=p["api_data_flush_rows"],
+        )
+        if should_load_batch:
+            data_path = await self._run(
+                api_data_to_parquet.run,
+                data_path="/tmp/api_data_cameras/",
+                dataframe=spooled_data,
+                batch_id=batch_id,
+            )
+            await self._run(
+                create_table_and_upload_to_gcs.run,
+                data_path=data_path,
+                dataset_id=p["dataset_id"],
+                table_id=p["table_id"],
+                biglake_table=True,
+                dump_mode="append",
+                source_format="parquet",
+            )
+            await self._run(
+                upload_to_native_table.run,
+                dataset_id=p["dataset_id"],
+                table_id=p["table_id"],
+                dataframe=spooled_data,
+            )
+            await self._run(
+                ack_spooled_api_data.run,
+                redis_client=self.redis_client,
+                spool_key=p["redis_key_api_data_spool"],
+            )
+        await self._run(
+            export_stage_metrics.run,
+            redis_client=self.redis_client,
+            metrics_key=p["redis_key_stage_metrics"],
+            textfile_path=p["metrics_textfile_path"],
+        )
+        log(f"Flooding detection cycle took {round(time.time() - start_time, 3)} seconds.")
+
+    async def run_forever(self):
+        """
+        Runs a cycle every `interval` seconds until `stop` is called. A failed cycle is
+        logged and the next one runs on schedule.
+        """
+        await self.setup()
+        while not self._stop.is_set():
+            start_time = time.time()
+            try:
+                await self.run_cycle()
+            except Exception as exc:
+                log(f"Flooding detection cycle failed: {exc}", level="error")
+            try:
+                await asyncio.wait_for(
+                    self._stop.wait(), timeout=max(self.interval - (time.time() - start_time), 0)
+                )
+            except asyncio.TimeoutError:
+                pass
+        self.executor.shutdown(wait=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs flooding detection as a service.")
+    parser.add_argument(
+        "--interval", type=float, default=180, help="Seconds between the start of two cycles."
+    )
+    parser.add_argument(
+        "--max-workers", type=int, default=100, help="Threads for the blocking stages."
+    )
+    parser.add_argument(
+        "--parameter",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="Overrides a flow parameter. Values are parsed as JSON when possible.",
+    )
+    args = parser.parse_args()
+
+    parameters = get_default_parameters()
+    for parameter in args.parameter:
+        name, value = parameter.split("=", 1)
+        if name not in parameters:
+            parser.error(f"Unknown parameter: {name}")
+        try:
+            parameters[name] = json.loads(value)
+        except json.JSONDecodeError:
+            parameters[name] = value
+
+    async def run():
+        service = FloodingDetectionService(
+            parameters=parameters, interval=args.interval, max_workers=args.max_workers
+        )
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, service.stop)
+        await service.run_forever()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,39 +1,57 @@
 # -*- coding: utf-8 -*-
-import base64
-import io
 import json
-import random
+import shutil
 import time
-from copy import deepcopy
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Dict, List, Tuple, Union
-from uuid import uuid4
+from typing import List, Tuple
 
 import basedosdados as bd
-import cv2
-import geopandas as gpd
-import google.generativeai as genai
+import h3
 import pandas as pd
-import pendulum
 import requests
-from google.cloud import bigquery
-from PIL import Image
+from google.cloud import bigquery, storage
 from prefect import task
-from prefeitura_rio.pipelines_utils.gcs import upload_file_to_bucket
+from prefect.triggers import all_finished
 from prefeitura_rio.pipelines_utils.infisical import get_secret
 from prefeitura_rio.pipelines_utils.logging import log
 from prefeitura_rio.pipelines_utils.pandas import parse_date_columns, to_partitions
 from prefeitura_rio.pipelines_utils.redis_pal import get_redis_client
 from prefeitura_rio.pipelines_utils.time import TimeoutError
 from redis_pal import RedisPal
-from shapely.geometry import Point
 
 from pipelines.deteccao_alagamento_cameras.flooding_detection.utils import (
-    download_file,
+    CameraRecord,
+    CaptureDeadlineError,
+    CaptureUnavailableError,
+    FloodingDataPublisher,
+    GeminiClassifier,
+    ObjectParameters,
+    PredictionQueue,
+    PredictionSpool,
+    api_data_to_dataframe,
+    archive_snapshot_to_bucket,
+    encode_snapshot,
+    format_prometheus_metrics,
+    get_camera_priority,
+    get_capture_executor,
+    get_frame_grabber_pool,
+    get_h3_index,
+    get_prediction_buffer_key,
+    get_prefilter_features,
+    get_sheet_dataframe,
+    get_stage_metrics,
+    get_storage_client,
     get_video_capture,
-    redis_add_to_prediction_buffer,
-    redis_get_prediction_buffer,
+    is_circuit_open,
+    is_prefilter_uncertain,
+    redis_add_stage_metrics,
+    redis_get_camera_health,
+    redis_get_last_checks,
+    redis_get_prediction_buffers,
+    redis_record_capture,
+    redis_set_last_checks,
+    upload_snapshot_to_bucket,
 )
 
 
@@ -109,134 +127,117 @@ def get_api_key(secret_path: str, secret_name: str = "GEMINI-PRO-VISION-API-KEY"
     return secret[secret_name]
 
 
-@task(
-    max_retries=3,
-    retry_delay=timedelta(seconds=1),
-)
-def get_prediction(
-    camera_with_image: Dict[str, Union[str, float]],
+@task(checkpoint=False)
+def get_prediction_queue(
     google_api_key: str,
     google_api_model: str,
-) -> Dict[str, Union[str, float, bool]]:
+    multi_object_prediction: bool = False,
+    redis_client: RedisPal = None,
+    prediction_cache_key: str = "flooding_detection_prediction_cache",
+    prediction_cache_max_distance: int = -1,
+    prediction_cache_ttl: int = 900,
+    requests_per_minute: float = 60,
+    max_concurrent_requests: int = 20,
+    publisher: FloodingDataPublisher = None,
+    prediction_memo_key: str = "flooding_detection_prediction_memo",
+    prediction_memo_ttl: int = 0,
+) -> PredictionQueue:
     """
-    Gets the flooding detection prediction from Google Gemini API.
+    Gets the queue that gets the flooding detection predictions from Google Gemini API for
+    every object of every camera submitted to it (see `submit_prediction`), reusing the
+    same snapshot for all objects of a camera.
+
+    All requests go through a single `GeminiClassifier`, concurrently with asyncio, under a
+    token bucket of `requests_per_minute` and with jittered exponential backoff on rate
+    limits. Cameras whose requests still fail get `None` labels instead of failing the
+    whole batch.
+
+    When `multi_object_prediction` is set and a camera has more than one object, all
+    objects are evaluated in a single request whose JSON answer is split back into one
+    classification per object. That request uses the generation parameters of the first
+    object (with the sum of all `max_output_token`), which is what gets recorded.
+
+    When a Redis client is given and `prediction_cache_max_distance` is not negative, the
+    label of an object is reused from the last prediction for that camera and object if its
+    frame's perceptual hash is within `prediction_cache_max_distance` bits of the current
+    one and the model and object parameters are unchanged. Reused labels are recorded with
+    the "cache" source. The flow enables it by default, with a distance of 4 bits.
+
+    When a Redis client is given and `prediction_memo_ttl` is positive, the response to
+    a request identical to one sent in the last `prediction_memo_ttl` seconds (same image
+    bytes, prompt, model and generation config) is reused instead of calling the model.
 
     Args:
-        camera_with_image: The camera with image in the following format:
-            {
-                "id_camera": "1",
-                "url_camera": "rtsp://...",
-                "latitude": -22.912,
-                "longitude": -43.230,
-                "image_base64": "base64...",
-                "attempt_classification": True,
-                "object": "alagamento",
-                "prompt": "You are ....",
-                "max_output_token": 300,
-                "temperature": 0.4,
-                "top_k": 1,
-                "top_p": 32,
-            }
         google_api_key: The Google API key.
-
-    Returns: The camera with image and classification in the following format:
-        {
-            "id_camera": "1",
-            "url_camera": "rtsp://...",
-            "latitude": -22.912,
-            "longitude": -43.230,
-            "image_base64": "base64...",
-            "ai_classification": [
-                {
-                    "object": "alagamento",
-                    "label": True,
-                    "confidence": 0.7,
-                    "prompt": "You are ....",
-                    "max_output_token": 300,
-                    "temperature": 0.4,
-                    "top_k": 1,
-                    "top_p": 32,
-                }
-            ],
-        }
+        google_api_model: The Google API model.
+        multi_object_prediction: Whether to evaluate all objects of a camera in a single
+            request.
+        redis_client: The Redis client used for the prediction cache.
+        prediction_cache_key: The Redis key prefix for the prediction cache.
+        prediction_cache_max_distance: The maximum Hamming distance between frame hashes to
+            reuse a cached prediction. Negative values disable the cache.
+        prediction_cache_ttl: Number of seconds a cached prediction can be reused for.
+        requests_per_minute: The Gemini API quota, in requests per minute.
+        max_concurrent_requests: Maximum number of requests in flight.
+        publisher: When given, each camera is published as soon as its predictions are done.
+        prediction_memo_key: The Redis key prefix for the memoized responses.
+        prediction_memo_ttl: Number of seconds a response is memoized for, 0 to disable.
     """
     # TODO:
     # - Add confidence value
-    # Setup the request
-    log(f"Getting prediction for id_camera: {camera_with_image['id_camera']}")  # noqa
-    log(f"Getting prediction for object: {camera_with_image['object']}")  # noqa
-    log(
-        f"Getting prediction for camera_with_image: {camera_with_image['image_base64'][:20] + '...' if camera_with_image['image_base64'] else None}"  # noqa
+    classifier = GeminiClassifier(
+        api_key=google_api_key,
+        model_name=google_api_model,
+        requests_per_minute=requests_per_minute,
+        max_concurrency=max_concurrent_requests,
+        redis_client=redis_client,
+        memo_key=prediction_memo_key,
+        memo_ttl=prediction_memo_ttl,
     )
-    if not camera_with_image["attempt_classification"]:
-        log("Skipping prediction for `attempt_classification` is False.")
-        camera_with_image["ai_classification"] = [
-            {
-                "object": camera_with_image["object"],
-                "label": False,
-                "confidence": 0.7,
-                "prompt": camera_with_image["prompt"],
-                "max_output_token": camera_with_image["max_output_token"],
-                "temperature": camera_with_image["temperature"],
-                "top_k": camera_with_image["top_k"],
-                "top_p": camera_with_image["top_p"],
-            }
-        ]
-        return camera_with_image
-    if not camera_with_image["image_base64"]:
-        log("Skipping prediction for `image_base64` is None.")
-        camera_with_image["ai_classification"] = [
-            {
-                "object": camera_with_image["object"],
-                "label": None,
-                "confidence": 0.7,
-                "prompt": camera_with_image["prompt"],
-                "max_output_token": camera_with_image["max_output_token"],
-                "temperature": camera_with_image["temperature"],
-                "top_k": camera_with_image["top_k"],
-                "top_p": camera_with_image["top_p"],
-            }
-        ]
-        return camera_with_image
-
-    label = None
-
-    img = Image.open(io.BytesIO(base64.b64decode(camera_with_image["image_base64"])))
-    genai.configure(api_key=google_api_key)
-    model = genai.GenerativeModel(google_api_model)
-    responses = model.generate_content(
-        contents=[camera_with_image["prompt"], img],
-        generation_config={
-            "max_output_tokens": camera_with_image["max_output_token"],
-            "temperature": camera_with_image["temperature"],
-            "top_p": camera_with_image["top_p"],
-            "top_k": camera_with_image["top_k"],
-        },
-        stream=True,
+    return PredictionQueue(
+        classifier,
+        on_prediction=publisher.publish if publisher is not None else None,
+        multi_object_prediction=multi_object_prediction,
+        redis_client=redis_client,
+        prediction_cache_key=prediction_cache_key,
+        prediction_cache_max_distance=prediction_cache_max_distance,
+        prediction_cache_ttl=prediction_cache_ttl,
     )
 
-    responses.resolve()
-    if isinstance(responses, tuple):
-        responses = responses[0]
-    json_string = responses.text.replace("```json\n", "").replace("\n```", "")
-    label = json.loads(json_string)["label"]
 
-    log(f"Successfully got prediction: {label}")
+@task(checkpoint=False)
+def submit_prediction(
+    camera_with_image: CameraRecord, prediction_queue: PredictionQueue
+) -> CameraRecord:
+    """
+    Starts getting the predictions of a camera as soon as its snapshot is ready, without
+    waiting for them.
+    """
+    prediction_queue.submit(camera_with_image)
+    return camera_with_image
 
-    camera_with_image["ai_classification"] = [
-        {
-            "object": camera_with_image["object"],
-            "label": label,
-            "confidence": 0.7,
-            "prompt": camera_with_image["prompt"],
-            "max_output_token": camera_with_image["max_output_token"],
-            "temperature": camera_with_image["temperature"],
-            "top_k": camera_with_image["top_k"],
-            "top_p": camera_with_image["top_p"],
-        }
-    ]
 
-    return camera_with_image
+@task
+def get_predictions(
+    cameras_with_image: List[CameraRecord],
+    prediction_queue: PredictionQueue,
+    deadline: float = None,
+) -> List[CameraRecord]:
+    """
+    Waits for the predictions of all cameras submitted to `prediction_queue`.
+
+    Args:
+        cameras_with_image: The cameras with image, as returned by `submit_prediction`.
+        prediction_queue: The prediction queue.
+        deadline: Timestamp after which the predictions still running are dropped, and their
+            cameras are published with `None` labels.
+
+    Returns:
+        The cameras with image and classification, with one `Classification` per object
+        in "ai_classification".
+    """
+    log(f"Waiting for the predictions of {len(cameras_with_image)} cameras.")
+    return prediction_queue.results(deadline=deadline)
 
 
 @task(
@@ -244,82 +245,206 @@ def get_prediction(
     retry_delay=timedelta(seconds=1),
 )
 def get_snapshot(
-    camera: Dict[str, Union[str, float]],
+    camera: CameraRecord,
     resize_width: int = 640,
     resize_height: int = 480,
-    snapshot_timeout: int = 300,
-) -> Dict[str, Union[str, float]]:
+    snapshot_timeout: int = 15,
+    use_stream_pool: bool = False,
+    max_concurrent_captures: int = 20,
+    deadline: float = None,
+    snapshot_format: str = "jpeg",
+    snapshot_quality: int = 75,
+    capture_backend: str = "ffmpeg",
+    redis_client: RedisPal = None,
+    health_key: str = None,
+    circuit_failure_threshold: int = 3,
+    circuit_backoff_base: float = 300,
+    circuit_backoff_max: float = 3600,
+) -> CameraRecord:
     """
     Gets a snapshot from a camera.
 
     Args:
-        camera: The camera in the following format:
-            {
-                "id_camera": "1",
-                "url_camera": "rtsp://...",
-                "latitude": -22.912,
-                "longitude": -43.230,
-                "image_base64": "base64...",
-                "attempt_classification": True,
-                "object": "alagamento",
-                "prompt": "You are ....",
-                "max_output_token": 300,
-                "temperature": 0.4,
-                "top_k": 1,
-                "top_p": 32,
-
-            }
+        camera: The camera, as returned by `pick_cameras`.
+        resize_width: The snapshot max width.
+        resize_height: The snapshot max height.
+        snapshot_timeout: Maximum number of seconds a capture runs, not counting the time
+            spent waiting for a free capture worker. It's also ffmpeg's RTSP I/O timeout, so
+            a dead camera doesn't hold a worker for longer than that.
+        use_stream_pool: Whether to read the frame from the process-wide pool of open
+            streams instead of opening a new connection to the camera.
+        max_concurrent_captures: Maximum number of capture subprocesses running at once in
+            this process.
+        deadline: Timestamp after which no more snapshots are taken. Captures wait for a
+            free worker until it, their timeout is clamped to the time left and cameras
+            reached after it are not attempted in this cycle.
+        snapshot_format: The snapshot encoding, "jpeg" or "webp".
+        snapshot_quality: The snapshot encoding quality, from 1 to 100.
+        capture_backend: The capture backend of cameras without one in the cameras sheet,
+            "ffmpeg" or "opencv". The stream pool is only used by "opencv" cameras.
+        redis_client: The Redis client, to record the capture in the camera health hash.
+        health_key: The Redis key for the camera health hash, see `redis_record_capture`.
+            Captures aren't recorded if it's not set.
+        circuit_failure_threshold: Number of consecutive failures that open the circuit of
+            a camera.
+        circuit_backoff_base: Number of seconds the circuit stays open after it opens,
+            doubling on each new failure.
+        circuit_backoff_max: Maximum number of seconds the circuit stays open.
 
     Returns:
-        The camera with image in the following format:
-            {
-                "id_camera": "1",
-                "url_camera": "rtsp://...",
-                "latitude": -22.912,
-                "longitude": -43.230,
-                "attempt_classification": True,
-                "image_base64": "base64...",
-            }
-    """
-    camera_id = camera.get("id_camera")
-    object_name = camera.get("object")
-    rtsp_url = camera.get("url_camera")
-
-    camera_log = f"camera_id: {camera_id}\nobject: {object_name}\n"
+        The camera with its "snapshot", or `None` if it couldn't be taken.
+    """
+    camera_id = camera.id_camera
+    object_names = [o.object for o in camera.objects]
+    rtsp_url = camera.url_camera
+
+    camera_log = f"camera_id: {camera_id}\nobjects: {object_names}\n"
+    if not camera.attempt_classification:
+        log(f"Skipping snapshot for {camera_id}: not scheduled for this cycle.")
+        get_stage_metrics().record("snapshot", not_scheduled=1)
+        camera.snapshot = None
+        return camera
+    if deadline is not None:
+        if deadline <= time.time():
+            log(f"Skipping snapshot for {camera_id}: cycle deadline reached.", level="warning")
+            get_stage_metrics().record("snapshot", deadline_skips=1)
+            camera.snapshot = None
+            camera.attempt_classification = False
+            return camera
     try:
         start_time = time.time()
-        cap, ret, frame = get_video_capture(rtsp_url=rtsp_url, timeout=snapshot_timeout)
+        backend = camera.capture_backend or capture_backend
+        if use_stream_pool and backend == "opencv":
+            ret, frame = get_frame_grabber_pool().read(
+                rtsp_url=rtsp_url, timeout=snapshot_timeout, deadline=deadline
+            )
+        else:
+            ret, frame = get_video_capture(
+                rtsp_url=rtsp_url,
+                timeout=snapshot_timeout,
+                deadline=deadline,
+                max_workers=max_concurrent_captures,
+                backend=backend,
+                max_width=resize_width,
+                max_height=resize_height,
+            )
         if not ret:
             raise RuntimeError("No ret returned.")
-        cap.release()
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        img = Image.fromarray(frame)
-        img.thumbnail((resize_width, resize_height))
-        buffer = io.BytesIO()
-        img.save(buffer, format="JPEG")
-        img_b64 = base64.b64encode(buffer.getvalue()).decode("utf-8")
+        snapshot = encode_snapshot(
+            frame,
+            max_width=resize_width,
+            max_height=resize_height,
+            image_format=snapshot_format,
+            quality=snapshot_quality,
+        )
 
         log(
             msg=f"Successfully got snapshot from URL {rtsp_url}.\n{camera_log}\nTake {round(time.time() - start_time, 3)} seconds."  # noqa
         )
-        camera["image_base64"] = img_b64
+        camera.snapshot = snapshot
+        outcome = "succeeded"
+    except (CaptureUnavailableError, CaptureDeadlineError) as e:
+        log(
+            f"Skipping snapshot for {camera_id}: cycle deadline reached before the capture finished.\n\nError:\n\n{e}",  # noqa
+            level="warning",
+        )
+        camera.snapshot = None
+        camera.attempt_classification = False
+        outcome = "deadline_skips"
     except TimeoutError as e:
         log(
             msg=f"Timeout to get snapshot from URL {rtsp_url}.\n{camera_log}\nTake {round(time.time() - start_time, 3)} seconds.\n\nError:\n\n{e}",  # noqa
             level="warning",
         )
-        camera["image_base64"] = None
+        camera.snapshot = None
+        outcome = "timeouts"
 
     except Exception as e:
         log(
             f"Failed to get snapshot from URL {rtsp_url}.\n{camera_log}\nTake {round(time.time() - start_time, 3)} seconds.\n\nError:\n\n{e}",  # noqa
             level="warning",
         )
-        camera["image_base64"] = None
-
+        camera.snapshot = None
+        outcome = "failures"
+    get_stage_metrics().record("snapshot", seconds=time.time() - start_time, **{outcome: 1})
+
+    # Only captures that ran to their own end say something about the camera
+    if outcome != "deadline_skips" and redis_client is not None and health_key:
+        try:
+            redis_record_capture(
+                camera_id,
+                redis_client=redis_client,
+                health_key=health_key,
+                success=camera.snapshot is not None,
+                latency=time.time() - start_time,
+                failure_threshold=circuit_failure_threshold,
+                backoff_base=circuit_backoff_base,
+                backoff_max=circuit_backoff_max,
+            )
+        except Exception as e:
+            log(f"Failed to record capture health of {camera_id}: {e}", level="warning")
+
+    if not use_stream_pool:
+        log(f"Capture metrics: {get_capture_executor().get_metrics()}")
     return camera
 
 
+@task
+def prefilter_snapshot(
+    camera_with_image: CameraRecord,
+    redis_client: RedisPal = None,
+    prefilter_key: str = "flooding_detection_prefilter",
+) -> CameraRecord:
+    """
+    Scores the snapshot with cheap local features and rules out, without calling the remote
+    model, the objects whose water-likeness score is below their `prefilter_threshold`.
+
+    Frames that are too dark, too blurry or that changed too much since the previous cycle
+    are considered uncertain and always go to the remote model. Objects without a
+    `prefilter_threshold` are never ruled out.
+
+    Args:
+        camera_with_image: The camera with image, as returned by `get_snapshot`.
+        redis_client: The Redis client, used to keep the previous frame thumbnail for the
+            frame difference.
+        prefilter_key: The Redis key prefix for the previous frame thumbnails.
+
+    Returns:
+        The camera with image, with "prefilter_labels" mapping the name of each object ruled
+        out to `False`.
+    """
+    thresholds = {
+        o.object: o.prefilter_threshold
+        for o in camera_with_image.objects
+        if o.prefilter_threshold is not None
+    }
+    if not thresholds or not camera_with_image.snapshot:
+        return camera_with_image
+
+    frame = camera_with_image.snapshot.decode()
+    thumbnail_key = f"{prefilter_key}_{camera_with_image.id_camera}"
+    previous_thumbnail = redis_client.get(thumbnail_key) if redis_client is not None else None
+    features = get_prefilter_features(frame, previous_thumbnail=previous_thumbnail)
+    if redis_client is not None:
+        redis_client.set(thumbnail_key, features.pop("thumbnail"), ex=3600)
+    else:
+        features.pop("thumbnail")
+    uncertain = is_prefilter_uncertain(features)
+    log(f"Pre-filter features for id_camera {camera_with_image.id_camera}: {features}")
+
+    if uncertain:
+        log("Pre-filter is uncertain, sending all objects to the model.")
+        return camera_with_image
+
+    camera_with_image.prefilter_labels = {
+        object_name: False
+        for object_name, threshold in thresholds.items()
+        if features["water_texture"] < threshold
+    }
+    log(f"Pre-filter ruled out: {list(camera_with_image.prefilter_labels)}")
+    return camera_with_image
+
+
 @task
 def pick_cameras(
     rain_api_data_url: str,
@@ -330,288 +455,423 @@ def pick_cameras(
     redis_client: RedisPal,
     number_mock_rain_cameras: int = 0,
     use_rain_api_data: bool = True,
-) -> List[Dict[str, Union[str, float]]]:
+    sheet_cache_key: str = "flooding_detection_sheet_cache",
+    sheet_cache_ttl: int = 600,
+    last_check_key: str = "flooding_detection_last_check",
+    cameras_budget: int = 0,
+    revisit_interval: int = 1800,
+    health_key: str = None,
+) -> List[CameraRecord]:
     """
     Picks cameras based on the raining hexagons and last update.
 
+    Cameras are ranked by the rain intensity of their hexagon, recent positive predictions,
+    proximity to a bolsão and time since their last check (see `get_camera_priority`), and
+    only the `cameras_budget` highest ranked ones are attempted in this cycle. Cameras whose
+    circuit is open (see `redis_record_capture`) are never attempted. The others are
+    returned with `attempt_classification` set to `False`.
+
     Args:
         rain_api_data_url: The rain API data url.
         last_update: The last update datetime.
-        predictions_buffer_key: The Redis key for the predictions buffer.
+        predictions_buffer_key: The Redis key prefix for the predictions buffers.
+        sheet_cache_key: The Redis key prefix for the cached cameras and object parameters
+            sheets.
+        sheet_cache_ttl: Number of seconds the cached sheets are used without revalidation.
+        last_check_key: The Redis key for the hash of the last check timestamp of each camera.
+        cameras_budget: Maximum number of cameras attempted per cycle, 0 for no limit.
+        revisit_interval: Number of seconds without a check that weigh as much as one level
+            of rain intensity, sets the cadence at which cameras without rain are visited.
+        health_key: The Redis key for the camera health hash, not used if not set.
 
     Returns:
-        A list of cameras in the following format:
-            [
-                {
-                    "id_camera": "1",
-                    "url_camera": "rtsp://...",
-                    "latitude": -22.912,
-                    "longitude": -43.230,
-                    "attempt_classification": True,
-                    "object": "alagamento",
-                    "prompt": "You are ....",
-                    "max_output_token": 300,
-                    "temperature": 0.4,
-                    "top_k": 1,
-                    "top_p": 32,
-                },
-                ...
-            ]
+        The cameras, each referencing the shared `ObjectParameters` of its objects.
     """
     # Download the cameras data
-    cameras_data_path = Path("/tmp") / "cameras_geo_min.csv"
-    if not download_file(url=cameras_data_url, output_path=cameras_data_path):
-        raise RuntimeError("Failed to download the cameras data.")
-
-    cameras = pd.read_csv(cameras_data_path)
+    cameras = get_sheet_dataframe(
+        url=cameras_data_url,
+        redis_client=redis_client,
+        cache_key=sheet_cache_key,
+        ttl=sheet_cache_ttl,
+    )
     cameras["id_camera"] = cameras["id_camera"].astype(str).str.zfill(6)
     # get only selected cameras from google sheets
     cameras = cameras[cameras["identificador"].notna()]
 
-    cameras = cameras.drop(columns=["geometry"])
-    geometry = [Point(xy) for xy in zip(cameras["longitude"], cameras["latitude"])]
-    df_cameras = gpd.GeoDataFrame(cameras, geometry=geometry)
-    df_cameras.crs = {"init": "epsg:4326"}
+    df_cameras = cameras.drop(columns=["geometry"], errors="ignore")
     log("Successfully downloaded cameras data.")
     log(f"Cameras shape: {df_cameras.shape}")
 
     if use_rain_api_data:
         # Get rain data
-        rain_data = requests.get(rain_api_data_url).json()
+        with get_stage_metrics().timer("rain_fetch"):
+            rain_data = requests.get(rain_api_data_url).json()
         df_rain = pd.DataFrame(rain_data)
         df_rain["last_update"] = last_update
         log("Successfully downloaded rain data.")
         log(f"Rain data shape: {df_rain.shape}")
 
-        # Join the dataframes
-        df_cameras_h3 = pd.merge(df_cameras, df_rain, how="left", on="id_h3")
-        log("Successfully joined the dataframes.")
-        log(f"Cameras H3 shape: {df_cameras_h3.shape}")
+        # Index cameras by their H3 cell at the rain data resolution and join by cell ID
+        if len(df_rain) > 0:
+            df_cameras["id_h3"] = get_h3_index(
+                df_cameras["latitude"],
+                df_cameras["longitude"],
+                resolution=h3.h3_get_resolution(df_rain["id_h3"].iloc[0]),
+            )
+            df_cameras_h3 = pd.merge(df_cameras, df_rain, how="left", on="id_h3")
+            log("Successfully joined the dataframes.")
+            log(f"Cameras H3 shape: {df_cameras_h3.shape}")
+        else:
+            log("Rain data is empty, cameras have no rain status.", level="warning")
+            df_cameras_h3 = df_cameras.copy()
+            df_cameras_h3["status"] = None
     else:
         df_cameras_h3 = df_cameras.copy()
         df_cameras_h3["status"] = None
 
-    # Modify status based on buffers
-    for _, row in df_cameras_h3.iterrows():
-        predictions_buffer_camera_key = f"{predictions_buffer_key}_{row['id_camera']}"
-        predictions_buffer = redis_get_prediction_buffer(
-            predictions_buffer_camera_key, redis_client=redis_client
+    # Expand to one row per camera and object
+    df_camera_objects = df_cameras_h3[["id_camera", "identificador"]].copy()
+    df_camera_objects["identificador"] = df_camera_objects["identificador"].str.split(",")
+    df_camera_objects = df_camera_objects.explode("identificador", ignore_index=True)
+    df_camera_objects["identificador"] = df_camera_objects["identificador"].str.strip()
+
+    # Modify status based on buffers, read for every camera and object in one round trip.
+    # A camera is flagged when the most common or the last prediction of any object is True
+    buffer_keys = [
+        get_prediction_buffer_key(predictions_buffer_key, id_camera, object_name)
+        for id_camera, object_name in zip(
+            df_camera_objects["id_camera"], df_camera_objects["identificador"]
         )
-        # Get most common prediction
-        most_common_prediction = max(set(predictions_buffer), key=predictions_buffer.count)
-        # Get last prediction
-        last_prediction = predictions_buffer[-1]
-        # Add classifications
-        if most_common_prediction or last_prediction:
-            row["status"] = "chuva moderada"
+    ]
+    predictions_buffers = redis_get_prediction_buffers(buffer_keys, redis_client=redis_client)
+    df_camera_objects["has_positive_buffer"] = [
+        bool(max(set(buffer), key=buffer.count) or buffer[-1])
+        for buffer in (predictions_buffers[key] for key in buffer_keys)
+    ]
+    has_positive_buffer = df_camera_objects.groupby("id_camera")["has_positive_buffer"].any()
+    df_cameras_h3["has_positive_buffer"] = (
+        df_cameras_h3["id_camera"].map(has_positive_buffer).fillna(False).astype(bool)
+    )
+    df_cameras_h3.loc[df_cameras_h3["has_positive_buffer"], "status"] = "chuva moderada"
 
     # Mock a few cameras when argument is set
     if number_mock_rain_cameras > 0:
-        df_len = len(df_cameras_h3)
-        for _ in range(number_mock_rain_cameras):
-            mocked_index = random.randint(0, df_len)
-            df_cameras_h3.loc[mocked_index, "status"] = "chuva moderada"
-            log(f'Mocked camera ID: {df_cameras_h3.loc[mocked_index]["id_camera"]}')
-
-    # expand dataframe when have multiples objects
-    df_cameras_h3_expanded = pd.DataFrame()
-    for _, row in df_cameras_h3.iterrows():
-        objetos = row["identificador"].split(",")
-        for objeto in objetos:
-            row["identificador"] = objeto.strip()
-            df_cameras_h3_expanded = pd.concat([df_cameras_h3_expanded, pd.DataFrame([row])])
+        mocked_cameras = df_cameras_h3.sample(n=min(number_mock_rain_cameras, len(df_cameras_h3)))
+        df_cameras_h3.loc[mocked_cameras.index, "status"] = "chuva moderada"
+        log(f"Mocked camera IDs: {mocked_cameras['id_camera'].tolist()}")
 
     # download the object parameters data
-    parameters_data_path = Path("/tmp/object_parameters.csv")
-    if not download_file(url=object_parameters_url, output_path=parameters_data_path):
-        raise RuntimeError("Failed to download the object parameters data.")
-    parameters = pd.read_csv(parameters_data_path)
-
-    # add the parameters to the cameras
-    df_cameras_h3_expanded = df_cameras_h3_expanded.merge(
-        parameters, left_on="identificador", right_on="objeto", how="left"
+    parameters = get_sheet_dataframe(
+        url=object_parameters_url,
+        redis_client=redis_client,
+        cache_key=sheet_cache_key,
+        ttl=sheet_cache_ttl,
+    )
+    if "prefilter_threshold" not in parameters.columns:
+        parameters["prefilter_threshold"] = None
+
+    # Build the object parameters table, with a single instance per object shared by all
+    # cameras, and group the cameras objects back by camera
+    parameters = parameters.astype(object).where(parameters.notna(), None)
+    object_parameters = {
+        row["objeto"]: ObjectParameters(
+            object=row["objeto"],
+            prompt=row["prompt"],
+            max_output_token=row["max_output_token"],
+            temperature=row["temperature"],
+            top_k=row["top_k"],
+            top_p=row["top_p"],
+            prefilter_threshold=row["prefilter_threshold"],
+        )
+        for row in parameters.to_dict("records")
+    }
+    unknown_objects = set(df_camera_objects["identificador"]) - set(object_parameters)
+    if unknown_objects:
+        log(f"Ignoring objects without parameters: {sorted(unknown_objects)}", level="warning")
+    df_camera_objects["objects"] = df_camera_objects["identificador"].map(object_parameters)
+    camera_objects = (
+        df_camera_objects.dropna(subset=["objects"])
+        .groupby("id_camera", sort=False)["objects"]
+        .agg(list)
+    )
+
+    # Set output, one entry per camera so its snapshot is shared by all of its objects
+    df_output = df_cameras_h3.drop_duplicates(subset="id_camera").copy()
+    # Cameras with no object left have nothing to classify, so they're not picked at all
+    without_objects = ~df_output["id_camera"].isin(camera_objects.index)
+    if without_objects.any():
+        log(
+            f"Ignoring cameras without known objects: "
+            f"{df_output.loc[without_objects, 'id_camera'].tolist()}",
+            level="warning",
+        )
+        df_output = df_output[~without_objects]
+    # Optional per camera capture backend, the flow default is used when blank
+    if "capture_backend" not in df_output.columns:
+        df_output["capture_backend"] = None
+    df_output["capture_backend"] = [
+        str(value).strip().lower() if pd.notna(value) and str(value).strip() else None
+        for value in df_output["capture_backend"]
+    ]
+
+    # Schedule the highest priority cameras within the budget
+    now = time.time()
+    last_checks = redis_get_last_checks(
+        df_output["id_camera"].tolist(), redis_client=redis_client, last_check_key=last_check_key
+    )
+    df_output["priority"] = get_camera_priority(
+        status=df_output["status"],
+        is_bolsao=df_output.get("is_bolsao", pd.Series(False, index=df_output.index)),
+        has_positive_buffer=df_output["has_positive_buffer"],
+        seconds_since_last_check=now - df_output["id_camera"].map(last_checks),
+        revisit_interval=revisit_interval,
+    )
+    camera_health = (
+        redis_get_camera_health(
+            df_output["id_camera"].tolist(), redis_client=redis_client, health_key=health_key
+        )
+        if health_key
+        else {}
+    )
+    circuit_open = df_output["id_camera"].map(
+        lambda id_camera: is_circuit_open(camera_health.get(id_camera, {}), now=now)
+    )
+    df_output["circuit_open"] = circuit_open
+    if circuit_open.any():
+        open_cameras = df_output.loc[circuit_open, "id_camera"].tolist()
+        log(f"Skipping cameras with open circuit: {open_cameras}")
+    if cameras_budget > 0:
+        scheduled = df_output.loc[~circuit_open, "priority"].nlargest(cameras_budget).index
+        df_output["attempt_classification"] = df_output.index.isin(scheduled)
+    else:
+        df_output["attempt_classification"] = ~circuit_open
+    redis_set_last_checks(
+        df_output.loc[df_output["attempt_classification"], "id_camera"].tolist(),
+        redis_client=redis_client,
+        last_check_key=last_check_key,
+        timestamp=now,
     )
-    # Set output
-    output = []
-    for _, row in df_cameras_h3_expanded.iterrows():
-        output.append(
-            {
-                "id_camera": row["id_camera"],
-                "nome_camera": row["nome"],
-                "url_camera": row["rtsp"],
-                "latitude": row["geometry"].y,
-                "longitude": row["geometry"].x,
-                "attempt_classification": True,  # noqa (row["status"] not in ["sem chuva", "chuva fraca"]),
-                "object": row["identificador"],
-                "prompt": row["prompt"],
-                "max_output_token": row["max_output_token"],
-                "temperature": row["temperature"],
-                "top_k": row["top_k"],
-                "top_p": row["top_p"],
-            }
+    log(
+        f"Scheduled {df_output['attempt_classification'].sum()} of {len(df_output)} cameras "
+        f"(budget: {cameras_budget or 'unlimited'})."
+    )
+
+    output = [
+        CameraRecord(
+            id_camera=row["id_camera"],
+            nome_camera=row["nome"],
+            url_camera=row["rtsp"],
+            latitude=row["latitude"],
+            longitude=row["longitude"],
+            objects=camera_objects[row["id_camera"]],
+            status=row["status"] if pd.notna(row["status"]) else None,
+            attempt_classification=bool(row["attempt_classification"]),
+            circuit_open=bool(row["circuit_open"]),
+            capture_backend=row["capture_backend"],
         )
+        for row in df_output.to_dict("records")
+    ]
 
-    output_log = json.dumps(output, indent=4)
+    output_log = json.dumps(
+        {
+            camera.id_camera: [camera_object.object for camera_object in camera.objects]
+            for camera in output
+            if camera.attempt_classification
+        },
+        indent=4,
+    )
     log(f"Picked cameras:\n {output_log}")
     return output
 
 
+@task(checkpoint=False)
+def get_cycle_deadline(timeout: float) -> float:
+    """
+    Gets the timestamp `timeout` seconds from now, after which the cycle stops waiting.
+    """
+    return time.time() + timeout
+
+
+@task(checkpoint=False)
+def get_flooding_data_publisher(
+    cameras: List[CameraRecord],
+    data_key: str,
+    last_update_key: str,
+    predictions_buffer_key: str,
+    redis_client: RedisPal,
+    publish_interval: float = 5,
+) -> FloodingDataPublisher:
+    """
+    Gets the publisher of the flooding detection data of the cameras picked for this cycle.
+
+    Args:
+        cameras: The cameras, as returned by `pick_cameras`.
+        data_key: The Redis key for the flooding detection data.
+        last_update_key: The Redis key for the last update datetime.
+        predictions_buffer_key: The Redis key prefix for the predictions buffers.
+        publish_interval: Minimum number of seconds between rebuilds of the API data while
+            predictions are being published.
+    """
+    return FloodingDataPublisher(
+        redis_client=redis_client,
+        data_key=data_key,
+        last_update_key=last_update_key,
+        predictions_buffer_key=predictions_buffer_key,
+        id_cameras=[camera.id_camera for camera in cameras],
+        min_interval=publish_interval,
+    )
+
+
 @task(nout=2)
 def update_flooding_api_data(
-    cameras_with_image_and_classification: List[Dict[str, Union[str, float, bool]]],
+    cameras_with_image_and_classification: List[CameraRecord],
     data_key: str,
     last_update_key: str,
     predictions_buffer_key: str,
     redis_client: RedisPal,
-) -> Tuple[List[Dict[str, Union[str, float, bool]]], bool]:
+    publisher: FloodingDataPublisher = None,
+) -> Tuple[List[CameraRecord], bool]:
     """
     Updates Redis keys with flooding detection data and last update datetime (now).
 
+    Cameras already published by `get_predictions` through `publisher` are not published
+    again. Cameras not attempted in this cycle are published with `None` labels, except the
+    ones with an open circuit, which are removed from the data.
+
     Args:
-        cameras_with_image_and_classification: The cameras with image and classification
-            in the following format:
-                [
-                    {
-                        "id_camera": "1",
-                        "url_camera": "rtsp://...",
-                        "latitude": -22.912,
-                        "longitude": -43.230,
-                        "image_base64": "base64...",
-                        "ai_classification": [
-                            {
-                                "object": "alagamento",
-                                "label": True,
-                                "confidence": 0.7,
-                                "prompt": "You are ....",
-                                "max_output_token": 300,
-                                "temperature": 0.4,
-                                "top_k": 1,
-                                "top_p": 32,
-                            }
-                        ],
-                    },
-                    ...
-                ]
+        cameras_with_image_and_classification: The cameras with image and classification,
+            as returned by `get_predictions`.
         data_key: The Redis key for the flooding detection data.
         last_update_key: The Redis key for the last update datetime.
-        predictions_buffer_key: The Redis key for the predictions buffer.
-    """
-    # Build API data
-    last_update = pendulum.now(tz="America/Sao_Paulo")
-    api_data = []
-    for camera_with_image_and_classification in cameras_with_image_and_classification:
-        ai_classification_api_list = []
-        for ai_classification in camera_with_image_and_classification.get("ai_classification", []):
-            # Get AI classifications
-            if ai_classification == []:
-                current_prediction = None
-            else:
-                current_prediction = ai_classification.get("label", None)
-
-            if current_prediction is None:
-                ai_classification_api_list.append(
-                    {
-                        "object": camera_with_image_and_classification["object"],
-                        "label": None,
-                        "confidence": None,
-                        "prompt": camera_with_image_and_classification["prompt"],
-                        "max_output_token": camera_with_image_and_classification[
-                            "max_output_token"
-                        ],
-                        "temperature": camera_with_image_and_classification["temperature"],
-                        "top_k": camera_with_image_and_classification["top_k"],
-                        "top_p": camera_with_image_and_classification["top_p"],
-                    }
-                )
-            else:
-                # TODO: add object the key name. Currently working for just one object
-                predictions_buffer_camera_key = f"{predictions_buffer_key}_{camera_with_image_and_classification['id_camera']}"  # noqa
-                predictions_buffer = redis_add_to_prediction_buffer(
-                    predictions_buffer_camera_key, current_prediction, redis_client=redis_client
-                )
-                # Get most common prediction
-                most_common_prediction = max(set(predictions_buffer), key=predictions_buffer.count)
-
-                ai_classification_api_list.append(
-                    {
-                        "object": camera_with_image_and_classification["object"],
-                        "label": most_common_prediction,
-                        "confidence": 0.7,
-                        "prompt": camera_with_image_and_classification["prompt"],
-                        "max_output_token": camera_with_image_and_classification[
-                            "max_output_token"
-                        ],
-                        "temperature": camera_with_image_and_classification["temperature"],
-                        "top_k": camera_with_image_and_classification["top_k"],
-                        "top_p": camera_with_image_and_classification["top_p"],
-                    }
-                )
-
-        # Add classifications
-        api_data_dict = {
-            "datetime": last_update.to_datetime_string(),
-            "id_camera": camera_with_image_and_classification["id_camera"],
-            "url_camera": camera_with_image_and_classification["url_camera"],
-            "latitude": camera_with_image_and_classification["latitude"],
-            "longitude": camera_with_image_and_classification["longitude"],
-            "image_base64": camera_with_image_and_classification["image_base64"],
-            "image_url": camera_with_image_and_classification["image_url"],
-            "ai_classification": ai_classification_api_list,
-        }
-        api_data.append(api_data_dict)
-
-    bq_data = deepcopy(api_data)
-    # clean api_data
-    for d in api_data:
-        d.pop("image_base64", None)
-        for c in d["ai_classification"]:
-            c.pop("prompt", None)
-            c.pop("max_output_token", None)
-            c.pop("temperature", None)
-            c.pop("top_k", None)
-            c.pop("top_p", None)
-
-    # Update API data
-    redis_client.set(data_key, api_data)
-    redis_client.set(last_update_key, last_update.to_datetime_string())
+        predictions_buffer_key: The Redis key prefix for the predictions buffers.
+        publisher: The publisher used while the predictions were made, if any.
+
+    Returns:
+        The cameras published in this cycle, with the labels given by the model, and whether
+        there's any.
+    """
+    if publisher is None:
+        publisher = FloodingDataPublisher(
+            redis_client=redis_client,
+            data_key=data_key,
+            last_update_key=last_update_key,
+            predictions_buffer_key=predictions_buffer_key,
+            id_cameras=[camera.id_camera for camera in cameras_with_image_and_classification],
+        )
+    publisher.publish(
+        [
+            camera
+            for camera in cameras_with_image_and_classification
+            if camera.id_camera not in publisher.published
+        ]
+    )
+    publisher.flush()
     log("Successfully updated flooding detection data.")
 
-    has_api_data = not len(api_data) == 0
+    has_api_data = not len(publisher.records) == 0
     log(f"has_api_data: {has_api_data}")
 
-    return bq_data, has_api_data
+    return publisher.records, has_api_data
 
 
-@task(nout=2)
-def api_data_to_csv(
-    data_path: str | Path, api_data: List[Dict[str, Union[str, float, bool]]], api_model: str
-) -> Tuple[str | Path, pd.DataFrame]:
-    base_path = Path(data_path)
+@task
+def spool_api_data(
+    api_data: List[CameraRecord], api_model: str, redis_client: RedisPal, spool_key: str
+) -> None:
+    """
+    Appends the BigQuery rows of the cameras published in this cycle to the spool. They're
+    loaded later, in batches, by `get_spooled_api_data`.
+    """
+    if not api_data:
+        return
+    dataframe = api_data_to_dataframe(api_data=api_data, api_model=api_model)
+    PredictionSpool(redis_client=redis_client, spool_key=spool_key).append(dataframe)
+    log(f"Spooled {len(dataframe)} rows.")
+
+
+@task(nout=3)
+def get_spooled_api_data(
+    redis_client: RedisPal,
+    spool_key: str,
+    flush_interval: float = 900,
+    flush_rows: int = 5000,
+    wait=None,
+) -> Tuple[pd.DataFrame, str, bool]:
+    """
+    Claims the spooled rows to be loaded to BigQuery, see `PredictionSpool.claim`.
+
+    Args:
+        redis_client: The Redis client.
+        spool_key: The Redis key of the spool.
+        flush_interval: Number of seconds after which spooled rows are loaded.
+        flush_rows: Number of spooled rows after which they're loaded.
+
+    Returns:
+        The rows to be loaded, the batch ID and whether there's any.
+    """
+    dataframe, batch_id = PredictionSpool(
+        redis_client=redis_client,
+        spool_key=spool_key,
+        flush_interval=flush_interval,
+        flush_rows=flush_rows,
+    ).claim()
+    return dataframe, batch_id, dataframe is not None
+
+
+@task
+def ack_spooled_api_data(redis_client: RedisPal, spool_key: str, wait=None) -> None:
+    """
+    Deletes the spooled rows claimed by `get_spooled_api_data`, once they're loaded.
+    """
+    PredictionSpool(redis_client=redis_client, spool_key=spool_key).ack()
+    log("Acknowledged spooled batch.")
+
 
-    data_normalized = []
-    for d in api_data:
-        normalized_dict = {}
-        for k, v in d.items():
-            if k == "ai_classification":
-                if len(v) > 0:
-                    normalized_dict = normalized_dict | v[0]
-            else:
-                normalized_dict[k] = v
-        data_normalized.append(normalized_dict)
-    dataframe = pd.DataFrame.from_records(data_normalized)
-    dataframe["model"] = api_model
+@task(skip_on_upstream_skip=False, trigger=all_finished)
+def export_stage_metrics(
+    redis_client: RedisPal, metrics_key: str, textfile_path: str = None, wait=None
+) -> None:
+    """
+    Moves the stage metrics accumulated in this process to Redis, see
+    `redis_add_stage_metrics`, and writes the running totals to a Prometheus textfile if
+    `textfile_path` is set. Runs even if upstream tasks failed or were skipped.
+    """
+    values = get_stage_metrics().pop()
+    totals = redis_add_stage_metrics(values, redis_client=redis_client, metrics_key=metrics_key)
+    cycle_seconds = {
+        stage: round(amount, 3) for (stage, name), amount in values.items() if name == "seconds"
+    }
+    log(f"Stage seconds in this cycle: {cycle_seconds}")
+    if textfile_path:
+        # Written aside and renamed, so the collector never reads a partial file
+        path = Path(textfile_path)
+        temporary_path = path.with_name(f".{path.name}.tmp")
+        temporary_path.write_text(format_prometheus_metrics(totals))
+        temporary_path.replace(path)
+
+
+@task
+def api_data_to_parquet(data_path: str | Path, dataframe: pd.DataFrame, batch_id: str) -> Path:
+    """
+    Writes a batch of rows as Parquet partitions. Files are named after the batch, so a
+    replayed batch overwrites its own files in the staging table.
+    """
+    base_path = Path(data_path)
+    # Files of previous batches would be uploaded again
+    shutil.rmtree(base_path, ignore_errors=True)
     dataframe, partition_columns = parse_date_columns(
         dataframe=dataframe, partition_date_column="datetime"
     )
-    saved_files = to_partitions(
-        data=dataframe,
-        partition_columns=partition_columns,
-        savepath=base_path,
-        data_type="csv",
-        suffix=f"{datetime.now().strftime('%Y%m%d-%H%M%S')}",
-    )
+    with get_stage_metrics().timer("parquet_write", rows=len(dataframe)):
+        saved_files = to_partitions(
+            data=dataframe,
+            partition_columns=partition_columns,
+            savepath=base_path,
+            data_type="parquet",
+            suffix=batch_id,
+        )
     log(f"saved_files:{saved_files}")
-    return base_path, dataframe
+    return base_path
 
 
 @task
@@ -650,11 +910,12 @@ def upload_to_native_table(
         bigquery.SchemaField("max_output_token", "INT64"),
         bigquery.SchemaField("temperature", "FLOAT64"),
         bigquery.SchemaField("top_k", "INT64"),
-        bigquery.SchemaField("top_p", "INT64"),
+        bigquery.SchemaField("top_p", "FLOAT64"),
         bigquery.SchemaField("latitude", "FLOAT64"),
         bigquery.SchemaField("longitude", "FLOAT64"),
         bigquery.SchemaField("geometry", "GEOGRAPHY"),
-        bigquery.SchemaField("image_base64", "STRING"),
+        bigquery.SchemaField("image_uri", "STRING"),
+        bigquery.SchemaField("source", "STRING"),
     ]
 
     job_config = bigquery.LoadJobConfig(
@@ -663,6 +924,8 @@ def upload_to_native_table(
         # to an existing table by default, but with WRITE_TRUNCATE write
         # disposition it replaces the table with the loaded data.
         write_disposition="WRITE_APPEND",
+        # image_uri replaced image_base64, which is kept for older rows, and source was added
+        schema_update_options=[bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION],
         time_partitioning=bigquery.TimePartitioning(
             type_=bigquery.TimePartitioningType.DAY,
             field="data_particao",  # name of column to use for partitioning
@@ -676,82 +939,81 @@ def upload_to_native_table(
     log(f"Write dataframe shape: {shape}")
     log(f"Write dataframe columns: {cols}")
 
-    job = table.client["bigquery_prod"].load_table_from_dataframe(
-        dataframe, table.table_full_name["prod"], job_config=job_config
-    )
-
-    job.result()
+    with get_stage_metrics().timer("bigquery_load", rows=len(dataframe)):
+        job = table.client["bigquery_prod"].load_table_from_dataframe(
+            dataframe, table.table_full_name["prod"], job_config=job_config
+        )
+        job.result()
 
 
 @task
 def upload_image_to_gcs(
-    camera_with_image: Dict[str, Union[str, float]], bucket_name: str, blob_base_path: str
-) -> Dict[str, Union[str, float]]:
+    camera_with_image: CameraRecord,
+    bucket_name: str,
+    blob_base_path: str,
+    archive_blob_base_path: str = None,
+    storage_client: storage.Client = None,
+) -> CameraRecord:
     """
-    Uploads an image to GCS.
+    Uploads the camera snapshot to GCS, once per camera regardless of its number of objects.
+
+    When `archive_blob_base_path` is set, the snapshot is first archived to a
+    content-addressed path that is never overwritten (see `archive_snapshot_to_bucket`),
+    whose URI is what gets stored in BigQuery, and then copied server-side to the latest
+    snapshot path of the camera.
 
     Args:
-        camera_with_image: The camera with image in the following format:
-            {
-                "id_camera": "1",
-                "url_camera": "rtsp://...",
-                "latitude": -22.912,
-                "longitude": -43.230,
-                "image_base64": "base64...",
-                "attempt_classification": True,
-                "object": "alagamento",
-                "prompt": "You are ....",
-                "max_output_token": 300,
-                "temperature": 0.4,
-                "top_k": 1,
-                "top_p": 32,
-            }
+        camera_with_image: The camera with image, as returned by `get_snapshot`.
         bucket_name: The GCS bucket name.
-        blob_base_path: The GCS blob base path.
+        blob_base_path: The GCS blob base path of the latest snapshots.
+        archive_blob_base_path: The GCS blob base path of the snapshots archive.
+        storage_client: The GCS client, the process-wide one if not given.
 
     Returns:
-        The camera with image in the following format:
-            {
-                "id_camera": "1",
-                "url_camera": "rtsp://...",
-                "latitude": -22.912,
-                "longitude": -43.230,
-                "image_base64": "base64...",
-                "attempt_classification": True,
-                "object": "alagamento",
-                "prompt": "You are ....",
-                "max_output_token": 300,
-                "temperature": 0.4,
-                "top_k": 1,
-                "top_p": 32,
-                "image_url": "https://storage.googleapis.com/...",
-            }
-    """
-    if not camera_with_image["image_base64"]:
-        log("Skipping upload for `image_base64` is None.")
-        camera_with_image["image_url"] = None
+        The camera with image, its public "image_url" and its archive "image_uri", or
+        `None` if they couldn't be uploaded.
+    """
+    if not camera_with_image.snapshot:
+        log("Skipping upload for `snapshot` is None.")
+        camera_with_image.image_url = None
         return camera_with_image
+    start_time = time.time()
     try:
         # Remove trailing slash
         blob_base_path = blob_base_path.rstrip("/")
-        # Save image to temp file
-        tmp_fname = f"/tmp/{uuid4()}.png"
-        img = Image.open(io.BytesIO(base64.b64decode(camera_with_image["image_base64"])))
-        with open(tmp_fname, "wb") as f:
-            img.save(f, format="PNG")
         # Set blob path
-        camera_id = camera_with_image["id_camera"]
-        blob_path = f"{blob_base_path}/{camera_id}.png"
+        camera_id = camera_with_image.id_camera
+        blob_path = f"{blob_base_path}/{camera_id}"
         log(f"Uploading image to GCS: {blob_path}")
-        blob = upload_file_to_bucket(
-            bucket_name=bucket_name,
-            file_path=tmp_fname,
-            destination_blob_name=blob_path,
-        )
+        if archive_blob_base_path:
+            archived_blob = archive_snapshot_to_bucket(
+                snapshot=camera_with_image.snapshot,
+                bucket_name=bucket_name,
+                blob_base_path=archive_blob_base_path,
+                id_camera=camera_id,
+                storage_client=storage_client,
+            )
+            camera_with_image.image_uri = f"gs://{bucket_name}/{archived_blob.name}"
+            bucket = (storage_client or get_storage_client()).bucket(bucket_name)
+            blob = bucket.copy_blob(
+                archived_blob,
+                bucket,
+                f"{blob_path}{camera_with_image.snapshot.extension}",
+            )
+        else:
+            blob = upload_snapshot_to_bucket(
+                snapshot=camera_with_image.snapshot,
+                bucket_name=bucket_name,
+                destination_blob_name=blob_path,
+                storage_client=storage_client,
+            )
         image_url = blob.public_url
-        camera_with_image["image_url"] = image_url
+        camera_with_image.image_url = image_url
         log(f"Successfully uploaded image to GCS: {blob_path}")
+        outcome = "succeeded"
     except Exception:
         log(f"Failed to upload image to GCS: {blob_path}")
-        camera_with_image["image_url"] = None
+        camera_with_image.image_url = None
+        outcome = "failures"
+    get_stage_metrics().record("gcs_upload", seconds=time.time() - start_time, **{outcome: 1})
     return camera_with_image
@@ -2,48 +2,840 @@
 """
 Data in: https://drive.google.com/drive/folders/1C-W_MMFAAJy5Lq_rHDzXUesEUyzke5gw
 """
+import asyncio
+import atexit
+import concurrent.futures
+import hashlib
+import io
+import json
 import queue
+import random
+import subprocess
+import sys
 import threading
 import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field, replace
+from functools import lru_cache, partial
 from io import StringIO
-from pathlib import Path
-from typing import Any, Dict, List, Union
+from typing import Any, Callable, Dict, Iterable, List, Tuple, Union
 
 import cv2
 import geopandas as gpd
+import google.generativeai as genai
 import h3
 import numpy as np
 import pandas as pd
+import pendulum
+import pyproj
 import requests
+import shapely
+from google.api_core import exceptions as google_exceptions
+from google.cloud import storage
 from PIL import Image, ImageDraw, ImageFont
 from prefeitura_rio.pipelines_utils.logging import log
 from prefeitura_rio.pipelines_utils.pandas import remove_columns_accents
 from prefeitura_rio.pipelines_utils.time import TimeoutError
 from redis_pal import RedisPal
-from shapely.geometry import Point, Polygon
+from shapely import STRtree
+from shapely.geometry import Point
 
+_CAPTURE_WORKER_SCRIPT = """
+import sys
 
-class VideoCaptureDaemon(threading.Thread):
-    def __init__(self, rtsp_url, result_queue):
+import cv2
+
+cap = cv2.VideoCapture(sys.argv[1])
+ret, frame = cap.read()
+cap.release()
+if not ret or frame is None:
+    sys.exit(1)
+sys.stdout.buffer.write(" ".join(str(dim) for dim in frame.shape).encode() + b"\\n")
+sys.stdout.buffer.write(frame.tobytes())
+"""
+
+
+def get_capture_command(
+    rtsp_url: str,
+    backend: str = "ffmpeg",
+    max_width: int = None,
+    max_height: int = None,
+    timeout: float = None,
+) -> List[str]:
+    """
+    Gets the command of a subprocess that reads a single frame from `rtsp_url`.
+
+    The "ffmpeg" backend only decodes keyframes, takes the first one, shrinks it on the
+    fly to fit `max_width` x `max_height` and writes it as a BMP image. The "opencv"
+    backend writes the raw frame, preceded by its shape. It starts a Python interpreter
+    and imports OpenCV for every capture, which costs several times the CPU and memory of
+    an ffmpeg process, so it's only meant for cameras that ffmpeg can't read.
+
+    RTSP streams are read over TCP, like OpenCV's FFmpeg backend does, as the ffmpeg CLI
+    tries UDP first and many cameras are behind NATs that drop it. If `timeout` is set,
+    ffmpeg gives up on an RTSP stream that sends nothing for `timeout` seconds.
+    """
+    if backend == "opencv":
+        return [sys.executable, "-c", _CAPTURE_WORKER_SCRIPT, rtsp_url]
+    if backend == "ffmpeg":
+        command = ["ffmpeg", "-nostdin", "-loglevel", "error", "-skip_frame", "nokey"]
+        if rtsp_url.startswith("rtsp://"):
+            command += ["-rtsp_transport", "tcp"]
+            if timeout:
+                command += ["-timeout", str(int(timeout * 1_000_000))]
+        command += ["-i", rtsp_url, "-frames:v", "1"]
+        if max_width and max_height:
+            command += [
+                "-vf",
+                f"scale='min({max_width},iw)':'min({max_height},ih)'"
+                ":force_original_aspect_ratio=decrease:flags=area",
+            ]
+        return command + ["-f", "image2pipe", "-c:v", "bmp", "-"]
+    raise ValueError(f"Unknown capture backend: {backend}")
+
+
+def decode_capture_output(output: bytes, backend: str = "ffmpeg") -> np.ndarray:
+    """
+    Decodes the output of a `get_capture_command` subprocess into a BGR frame.
+    """
+    if backend == "ffmpeg":
+        frame = cv2.imdecode(np.frombuffer(output, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if frame is None:
+            raise RuntimeError("ffmpeg returned an invalid image.")
+        return frame
+    header, data = output.split(b"\n", 1)
+    shape = tuple(int(dim) for dim in header.split())
+    return np.frombuffer(data, dtype=np.uint8).reshape(shape)
+
+
+class CaptureUnavailableError(TimeoutError):
+    """
+    No capture worker became free before the deadline, so the camera wasn't read.
+    """
+
+
+class CaptureDeadlineError(TimeoutError):
+    """
+    The capture was cut short by the deadline before its own timeout, so its outcome says
+    nothing about the camera.
+    """
+
+
+class CaptureExecutor:
+    """
+    Runs camera captures in subprocesses, at most `max_workers` at a time.
+
+    Unlike a thread stuck inside `cv2.VideoCapture`, a subprocess can be killed, so a
+    capture that times out releases its socket and memory right away.
+    """
+
+    def __init__(self, max_workers: int = 20):
+        self.max_workers = max_workers
+        self._semaphore = threading.BoundedSemaphore(max_workers)
+        self._lock = threading.Lock()
+        self._metrics = {
+            "queued": 0,
+            "in_flight": 0,
+            "succeeded": 0,
+            "failed": 0,
+            "abandoned": 0,
+        }
+
+    def capture(
+        self,
+        rtsp_url: str,
+        timeout: float = 15,
+        deadline: float = None,
+        backend: str = "ffmpeg",
+        max_width: int = None,
+        max_height: int = None,
+    ) -> Tuple[bool, np.ndarray]:
+        """
+        Reads a single frame from `rtsp_url`.
+
+        Args:
+            rtsp_url: The RTSP URL.
+            timeout: Maximum number of seconds the capture runs, once it gets a worker.
+            deadline: Timestamp until which to wait for a free worker. The capture timeout
+                is clamped to the time left after it. If not set, waits for a worker for
+                at most `timeout` seconds.
+            backend: The capture backend, see `get_capture_command`.
+            max_width: The frame max width, only used by the "ffmpeg" backend.
+            max_height: The frame max height, only used by the "ffmpeg" backend.
+
+        Returns:
+            A tuple `(ret, frame)`, like `cv2.VideoCapture.read`.
+
+        Raises:
+            CaptureUnavailableError: If no worker became free in time.
+            CaptureDeadlineError: If the capture timed out after being clamped to the
+                deadline.
+            TimeoutError: If the capture timed out.
+        """
+        queue_timeout = timeout if deadline is None else max(deadline - time.time(), 0)
+        self._incr("queued")
+        acquired = self._semaphore.acquire(timeout=queue_timeout)
+        self._incr("queued", -1)
+        if not acquired:
+            self._incr("abandoned")
+            raise CaptureUnavailableError(
+                "No capture worker available after {:.3f}s".format(queue_timeout)
+            )
+        start_time = time.time()
+        clamped = deadline is not None and deadline - start_time < timeout
+        if clamped:
+            timeout = deadline - start_time
+            if timeout <= 0:
+                self._semaphore.release()
+                self._incr("abandoned")
+                raise CaptureUnavailableError("Deadline reached while waiting for a capture worker")
+        self._incr("in_flight")
+        try:
+            process = subprocess.Popen(
+                get_capture_command(
+                    rtsp_url,
+                    backend=backend,
+                    max_width=max_width,
+                    max_height=max_height,
+                    timeout=timeout,
+                ),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            )
+            try:
+                output, _ = process.communicate(timeout=max(timeout, 0))
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.communicate()
+                self._incr("abandoned")
+                error = CaptureDeadlineError if clamped else TimeoutError
+                raise error("Timeout occurred after {:.3f}s".format(time.time() - start_time))
+        finally:
+            self._incr("in_flight", -1)
+            self._semaphore.release()
+
+        if process.returncode != 0 or not output:
+            self._incr("failed")
+            return False, None
+        frame = decode_capture_output(output, backend=backend)
+        self._incr("succeeded")
+        return True, frame
+
+    def get_metrics(self) -> Dict[str, int]:
+        """
+        Gets a copy of the capture counters.
+        """
+        with self._lock:
+            return dict(self._metrics)
+
+    def _incr(self, metric: str, amount: int = 1):
+        with self._lock:
+            self._metrics[metric] += amount
+
+
+_capture_executor = None
+_capture_executor_lock = threading.Lock()
+
+
+def get_capture_executor(max_workers: int = 20) -> CaptureExecutor:
+    """
+    Gets the process-wide `CaptureExecutor`, creating it on first use.
+
+    Args:
+        max_workers: Maximum number of concurrent captures. Only used on creation.
+    """
+    global _capture_executor
+    with _capture_executor_lock:
+        if _capture_executor is None:
+            _capture_executor = CaptureExecutor(max_workers=max_workers)
+        return _capture_executor
+
+
+def get_video_capture(
+    rtsp_url: str,
+    timeout: float = 15,
+    deadline: float = None,
+    max_workers: int = 20,
+    backend: str = "ffmpeg",
+    max_width: int = None,
+    max_height: int = None,
+) -> Tuple[bool, np.ndarray]:
+    """
+    Reads a single frame from `rtsp_url` using the process-wide `CaptureExecutor`.
+
+    Args:
+        rtsp_url: The RTSP URL.
+        timeout: Maximum number of seconds the capture runs, once it gets a worker.
+        deadline: Timestamp until which to wait for a free worker, see
+            `CaptureExecutor.capture`.
+        max_workers: Maximum number of concurrent captures.
+        backend: The capture backend, "opencv" or "ffmpeg".
+        max_width: The frame max width, only used by the "ffmpeg" backend.
+        max_height: The frame max height, only used by the "ffmpeg" backend.
+
+    Returns:
+        A tuple `(ret, frame)`, like `cv2.VideoCapture.read`.
+    """
+    return get_capture_executor(max_workers=max_workers).capture(
+        rtsp_url,
+        timeout=timeout,
+        deadline=deadline,
+        backend=backend,
+        max_width=max_width,
+        max_height=max_height,
+    )
+
+
+@dataclass(slots=True)
+class Snapshot:
+    """
+    An encoded camera frame. It is encoded once, right after capture, and the same bytes
+    are uploaded to GCS and sent to the model.
+    """
+
+    data: bytes
+    mime_type: str = "image/jpeg"
+
+    @property
+    def extension(self) -> str:
+        return {"image/jpeg": ".jpg", "image/png": ".png", "image/webp": ".webp"}[self.mime_type]
+
+    def decode(self, flags: int = cv2.IMREAD_COLOR) -> np.ndarray:
+        """
+        Decodes the frame with OpenCV (BGR by default).
+        """
+        return cv2.imdecode(np.frombuffer(self.data, dtype=np.uint8), flags)
+
+    @property
+    def sha256(self) -> str:
+        return hashlib.sha256(self.data).hexdigest()
+
+    def to_blob(self) -> Dict[str, Union[str, bytes]]:
+        """
+        Gets the frame as an inline blob for the Gemini API.
+        """
+        return {"mime_type": self.mime_type, "data": self.data}
+
+
+SNAPSHOT_FORMATS = {
+    "jpeg": ("image/jpeg", ".jpg", cv2.IMWRITE_JPEG_QUALITY),
+    "webp": ("image/webp", ".webp", cv2.IMWRITE_WEBP_QUALITY),
+}
+
+
+def encode_snapshot(
+    frame: np.ndarray,
+    max_width: int = 640,
+    max_height: int = 480,
+    image_format: str = "jpeg",
+    quality: int = 75,
+) -> Snapshot:
+    """
+    Encodes a BGR frame, as read by OpenCV, into a snapshot. The frame is first shrunk to
+    fit `max_width` x `max_height`, keeping its aspect ratio, so the encoder only sees the
+    small image. Frames are never enlarged.
+
+    Args:
+        frame: The frame.
+        max_width: The snapshot max width.
+        max_height: The snapshot max height.
+        image_format: "jpeg" or "webp".
+        quality: The encoding quality, from 1 to 100.
+
+    Returns:
+        The snapshot.
+    """
+    mime_type, extension, quality_flag = SNAPSHOT_FORMATS[image_format]
+    height, width = frame.shape[:2]
+    scale = min(max_width / width, max_height / height)
+    if scale < 1:
+        frame = cv2.resize(
+            frame,
+            (max(round(width * scale), 1), max(round(height * scale), 1)),
+            interpolation=cv2.INTER_AREA,
+        )
+    ret, buffer = cv2.imencode(extension, frame, [quality_flag, quality])
+    if not ret:
+        raise RuntimeError(f"Failed to encode frame as {image_format}.")
+    return Snapshot(data=buffer.tobytes(), mime_type=mime_type)
+
+
+@dataclass(slots=True)
+class ObjectParameters:
+    """
+    The prompt and generation parameters of an object, from the object parameters sheet.
+    A single instance is shared by all cameras that look for the object.
+    """
+
+    object: str
+    prompt: str
+    max_output_token: int
+    temperature: float
+    top_k: int
+    top_p: float
+    prefilter_threshold: float = None
+
+    def to_generation_config(self) -> Dict[str, Any]:
+        return {
+            "max_output_tokens": self.max_output_token,
+            "temperature": self.temperature,
+            "top_p": self.top_p,
+            "top_k": self.top_k,
+        }
+
+
+@dataclass(slots=True)
+class Classification:
+    """
+    The label of an object in a snapshot. `parameters` are the ones actually sent to the
+    model, the object's own unless it was evaluated in a multi-object request. `source` is
+    where the label comes from: "model", "prefilter" when the local pre-filter ruled the
+    object out, or "cache" when it was reused from a nearly identical frame.
+    """
+
+    parameters: ObjectParameters
+    label: bool = None
+    confidence: float = None
+    source: str = None
+
+    @property
+    def object(self) -> str:
+        return self.parameters.object
+
+
+@dataclass(slots=True)
+class CameraRecord:
+    """
+    A camera going through a flooding detection cycle. The snapshot and the object
+    parameters are held by reference, never copied.
+    """
+
+    id_camera: str
+    nome_camera: str
+    url_camera: str
+    latitude: float
+    longitude: float
+    objects: List[ObjectParameters]
+    status: str = None
+    attempt_classification: bool = True
+    circuit_open: bool = False
+    capture_backend: str = None
+    snapshot: Snapshot = None
+    image_url: str = None
+    image_uri: str = None
+    prefilter_labels: Dict[str, bool] = field(default_factory=dict)
+    ai_classification: List[Classification] = field(default_factory=list)
+    datetime: str = None
+
+
+_storage_client = None
+_storage_client_lock = threading.Lock()
+
+
+def get_storage_client() -> storage.Client:
+    """
+    Gets the process-wide GCS client, creating it on first use.
+    """
+    global _storage_client
+    with _storage_client_lock:
+        if _storage_client is None:
+            _storage_client = storage.Client()
+        return _storage_client
+
+
+def upload_snapshot_to_bucket(
+    snapshot: Snapshot,
+    bucket_name: str,
+    destination_blob_name: str,
+    storage_client: storage.Client = None,
+) -> storage.Blob:
+    """
+    Uploads a snapshot to GCS straight from memory.
+
+    Args:
+        snapshot: The snapshot.
+        bucket_name: The GCS bucket name.
+        destination_blob_name: The blob path, without extension.
+        storage_client: The GCS client, the process-wide one if not given.
+
+    Returns:
+        The uploaded blob.
+    """
+    blob = (
+        (storage_client or get_storage_client())
+        .bucket(bucket_name)
+        .blob(f"{destination_blob_name}{snapshot.extension}")
+    )
+    blob.upload_from_string(snapshot.data, content_type=snapshot.mime_type)
+    return blob
+
+
+def archive_snapshot_to_bucket(
+    snapshot: Snapshot,
+    bucket_name: str,
+    blob_base_path: str,
+    id_camera: str,
+    storage_client: storage.Client = None,
+) -> storage.Blob:
+    """
+    Uploads a snapshot to a content-addressed path that is never overwritten:
+    `{blob_base_path}/{date}/{id_camera}/{sha256}{extension}`. A frame identical to one
+    already archived that day is not uploaded again.
+
+    Args:
+        snapshot: The snapshot.
+        bucket_name: The GCS bucket name.
+        blob_base_path: The GCS blob base path of the archive.
+        id_camera: The camera ID.
+        storage_client: The GCS client, the process-wide one if not given.
+
+    Returns:
+        The archived blob.
+    """
+    date = pendulum.now(tz="America/Sao_Paulo").to_date_string()
+    blob = (
+        (storage_client or get_storage_client())
+        .bucket(bucket_name)
+        .blob(
+            f"{blob_base_path.rstrip('/')}/{date}/{id_camera}/{snapshot.sha256}{snapshot.extension}"
+        )
+    )
+    try:
+        blob.upload_from_string(
+            snapshot.data, content_type=snapshot.mime_type, if_generation_match=0
+        )
+    except google_exceptions.PreconditionFailed:
+        log(f"Snapshot already archived: {blob.name}")
+    return blob
+
+
+class FrameGrabber(threading.Thread):
+    """
+    Keeps an RTSP stream open in the background and serves its freshest frame on demand.
+
+    Nothing is grabbed between requests, so an idle stream costs no decoding, but the
+    frames sent meanwhile pile up in the socket and demuxer buffers (OpenCV's FFmpeg
+    backend ignores `CAP_PROP_BUFFERSIZE`). On each request they are grabbed and dropped
+    until a grab has to wait for the camera, and the last one is returned. If that takes
+    more than `max_drain` seconds, the stream is re-opened instead. When the stream can't be
+    opened, requests fail without retrying until an exponential backoff has passed. A
+    stream that drops is re-opened once within the request.
+    """
+
+    def __init__(
+        self,
+        rtsp_url: str,
+        backoff_base: float = 1,
+        backoff_max: float = 60,
+        max_drain: float = 2,
+    ):
         super().__init__()
         self.daemon = True
         self.rtsp_url = rtsp_url
-        self.result_queue = result_queue
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_drain = max_drain
+        self.last_used = time.time()
+        self._cap = None
+        self._backoff = backoff_base
+        self._retry_at = 0
+        self._pending = queue.Queue()
+        self._stop_event = threading.Event()
 
     def run(self):
-        self.result_queue.put(cv2.VideoCapture(self.rtsp_url))
+        while not self._stop_event.is_set():
+            try:
+                result_queue = self._pending.get(timeout=1)
+            except queue.Empty:
+                continue
+            was_open = self._cap is not None
+            ret, frame = self._read_frame()
+            if not ret and was_open:
+                # The stream may have dropped while idle
+                ret, frame = self._read_frame()
+            result_queue.put((ret, frame))
+        self._release()
+        self._answer_pending(False, None)
+
+    def read(self, timeout: float = 5, deadline: float = None) -> Tuple[bool, np.ndarray]:
+        """
+        Gets the freshest frame of the stream.
+
+        Args:
+            timeout: Maximum number of seconds to wait for a frame.
+            deadline: Timestamp the timeout is clamped to. `CaptureDeadlineError` is raised
+                instead of `TimeoutError` if the clamped timeout runs out.
+
+        Returns:
+            A tuple `(ret, frame)`, like `cv2.VideoCapture.read`.
+        """
+        self.last_used = time.time()
+        result_queue = queue.Queue(maxsize=1)
+        self._pending.put(result_queue)
+        start_time = time.time()
+        clamped = deadline is not None and deadline - start_time < timeout
+        if clamped:
+            timeout = max(deadline - start_time, 0)
+        try:
+            return result_queue.get(block=True, timeout=timeout)
+        except queue.Empty:
+            error = CaptureDeadlineError if clamped else TimeoutError
+            raise error("Timeout occurred after {:.3f}s".format(time.time() - start_time))
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _read_frame(self) -> Tuple[bool, np.ndarray]:
+        if self._cap is not None:
+            if self._drain():
+                ret, frame = self._cap.retrieve()
+                if not ret:
+                    self._release()
+                return ret, frame
+            # The stream dropped, or is too far behind to catch up
+            self._release()
+        if time.time() < self._retry_at:
+            return False, None
+        cap = cv2.VideoCapture(self.rtsp_url)
+        if not cap.isOpened():
+            cap.release()
+            self._retry_at = time.time() + self._backoff
+            self._backoff = min(self._backoff * 2, self.backoff_max)
+            return False, None
+        self._cap = cap
+        self._backoff = self.backoff_base
+        ret, frame = self._cap.read()
+        if not ret:
+            self._release()
+        return ret, frame
+
+    def _drain(self) -> bool:
+        """
+        Grabs the frames buffered since the last request until a grab takes at least half a
+        frame interval, i.e. it waited for the camera to send a new frame.
+
+        Returns:
+            Whether the stream caught up within `max_drain` seconds.
+        """
+        fps = self._cap.get(cv2.CAP_PROP_FPS)
+        frame_interval = 1 / fps if 1 <= fps <= 60 else 1 / 25
+        start_time = time.time()
+        while time.time() - start_time < self.max_drain:
+            grab_start = time.time()
+            if not self._cap.grab():
+                return False
+            if time.time() - grab_start >= frame_interval / 2:
+                return True
+        return False
+
+    def _answer_pending(self, ret: bool, frame: np.ndarray):
+        while True:
+            try:
+                self._pending.get_nowait().put((ret, frame))
+            except queue.Empty:
+                return
+
+    def _release(self):
+        if self._cap is not None:
+            self._cap.release()
+            self._cap = None
+
+
+class FrameGrabberPool:
+    """
+    Long-lived pool of `FrameGrabber`s, one per RTSP URL.
 
+    Streams are opened on first use and closed after `idle_timeout` seconds without
+    requests, or when the pool is full and a new stream is needed (least recently used
+    first). Each open stream holds a connection and a decoder, and decodes on every
+    request, so `max_streams` is kept small enough for a single CPU.
+    """
 
-def get_video_capture(rtsp_url, timeout=5):
-    res_queue = queue.Queue()
-    VideoCaptureDaemon(rtsp_url, res_queue).start()
-    start_time = time.time()
-    try:
-        cap = res_queue.get(block=True, timeout=timeout)
-        ret, frame = cap.read()
-        return cap, ret, frame
-    except queue.Empty:
-        raise TimeoutError("Timeout occurred after {:.3f}s".format(time.time() - start_time))
+    def __init__(
+        self,
+        max_streams: int = 20,
+        idle_timeout: float = 600,
+        backoff_base: float = 1,
+        backoff_max: float = 60,
+    ):
+        self.max_streams = max_streams
+        self.idle_timeout = idle_timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._grabbers: Dict[str, FrameGrabber] = {}
+        self._lock = threading.Lock()
+
+    def read(
+        self, rtsp_url: str, timeout: float = 5, deadline: float = None
+    ) -> Tuple[bool, np.ndarray]:
+        """
+        Gets the freshest frame from `rtsp_url`, opening the stream if needed.
+
+        Args:
+            rtsp_url: The RTSP URL.
+            timeout: Maximum number of seconds to wait for a frame.
+            deadline: Timestamp the timeout is clamped to, see `FrameGrabber.read`.
+
+        Returns:
+            A tuple `(ret, frame)`, like `cv2.VideoCapture.read`.
+        """
+        with self._lock:
+            self._evict_idle()
+            grabber = self._grabbers.get(rtsp_url)
+            if grabber is None or not grabber.is_alive():
+                if len(self._grabbers) >= self.max_streams:
+                    oldest_url = min(self._grabbers, key=lambda url: self._grabbers[url].last_used)
+                    self._grabbers.pop(oldest_url).stop()
+                grabber = FrameGrabber(
+                    rtsp_url, backoff_base=self.backoff_base, backoff_max=self.backoff_max
+                )
+                grabber.start()
+                self._grabbers[rtsp_url] = grabber
+        return grabber.read(timeout=timeout, deadline=deadline)
+
+    def close(self, rtsp_url: str):
+        with self._lock:
+            grabber = self._grabbers.pop(rtsp_url, None)
+        if grabber is not None:
+            grabber.stop()
+
+    def close_all(self):
+        with self._lock:
+            grabbers = list(self._grabbers.values())
+            self._grabbers.clear()
+        for grabber in grabbers:
+            grabber.stop()
+        for grabber in grabbers:
+            grabber.join(timeout=1)
+
+    def _evict_idle(self):
+        now = time.time()
+        for url in [
+            url
+            for url, grabber in self._grabbers.items()
+            if now - grabber.last_used > self.idle_timeout
+        ]:
+            self._grabbers.pop(url).stop()
+
+
+_frame_grabber_pool = None
+_frame_grabber_pool_lock = threading.Lock()
+
+
+def get_frame_grabber_pool() -> FrameGrabberPool:
+    """
+    Gets the process-wide `FrameGrabberPool`, creating it on first use.
+    """
+    global _frame_grabber_pool
+    with _frame_grabber_pool_lock:
+        if _frame_grabber_pool is None:
+            _frame_grabber_pool = FrameGrabberPool()
+            atexit.register(_frame_grabber_pool.close_all)
+        return _frame_grabber_pool
+
+
+class StageMetrics:
+    """
+    Process-wide accumulator of the time spent and the events counted in each stage of a
+    cycle. Stages record into it as they run, and `export_stage_metrics` moves what was
+    accumulated to Redis at the end of the cycle.
+    """
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float = None, **counters: float) -> None:
+        """
+        Records a stage call that took `seconds`, if given, and increments its `counters`.
+        """
+        if seconds is not None:
+            counters = {"calls": 1, "seconds": seconds, **counters}
+        with self._lock:
+            for name, amount in counters.items():
+                self._values[(stage, name)] = self._values.get((stage, name), 0) + amount
+
+    @contextmanager
+    def timer(self, stage: str, **counters: float):
+        """
+        Records the time spent in the block as a call of `stage`.
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, seconds=time.perf_counter() - start_time, **counters)
+
+    def pop(self) -> Dict[Tuple[str, str], float]:
+        """
+        Gets the values accumulated since the last call, by stage and counter name.
+        """
+        with self._lock:
+            values, self._values = self._values, {}
+        return values
+
+
+_stage_metrics = StageMetrics()
+
+
+def get_stage_metrics() -> StageMetrics:
+    """
+    Gets the process-wide `StageMetrics`.
+    """
+    return _stage_metrics
+
+
+def redis_add_stage_metrics(
+    values: Dict[Tuple[str, str], float], redis_client: RedisPal, metrics_key: str
+) -> Dict[str, float]:
+    """
+    Adds the values of a cycle to the running totals in the Redis hash `metrics_key`, and
+    replaces the hash `{metrics_key}:last_cycle` with them, in a single transaction. Fields
+    are named "{stage}:{counter}".
+
+    Returns:
+        The running totals.
+    """
+    fields = {f"{stage}:{name}": amount for (stage, name), amount in values.items()}
+    pipeline = redis_client.pipeline(transaction=True)
+    for field_name, amount in fields.items():
+        pipeline.hincrbyfloat(metrics_key, field_name, amount)
+    pipeline.delete(f"{metrics_key}:last_cycle")
+    if fields:
+        pipeline.hset(f"{metrics_key}:last_cycle", mapping=fields)
+    pipeline.hgetall(metrics_key)
+    totals = pipeline.execute()[-1]
+    return {field_name.decode(): float(amount) for field_name, amount in totals.items()}
+
+
+def format_prometheus_metrics(totals: Dict[str, float], prefix: str = "flooding_detection") -> str:
+    """
+    Formats the running totals of `redis_add_stage_metrics` in the Prometheus text format:
+    the "seconds" of each stage as `{prefix}_stage_seconds_total` and every other counter
+    as `{prefix}_stage_events_total`, labeled by stage and event.
+    """
+    seconds_lines, event_lines = [], []
+    for field_name, amount in sorted(totals.items()):
+        stage, name = field_name.split(":", 1)
+        if name == "seconds":
+            seconds_lines.append(f'{prefix}_stage_seconds_total{{stage="{stage}"}} {amount}')
+        else:
+            event_lines.append(
+                f'{prefix}_stage_events_total{{stage="{stage}",event="{name}"}} {amount}'
+            )
+    return (
+        "\n".join(
+            [
+                f"# HELP {prefix}_stage_seconds_total Time spent in each stage.",
+                f"# TYPE {prefix}_stage_seconds_total counter",
+                *seconds_lines,
+                f"# HELP {prefix}_stage_events_total Events counted in each stage.",
+                f"# TYPE {prefix}_stage_events_total counter",
+                *event_lines,
+            ]
+        )
+        + "\n"
+    )
 
 
 def add_text_to_image(image: Image = None, text: str = None):
@@ -61,37 +853,198 @@ def add_text_to_image(image: Image = None, text: str = None):
     return image
 
 
-def download_file(url: str, output_path: Union[str, Path]) -> bool:
+def get_sheet_cache_key(url: str, cache_key: str = "flooding_detection_sheet_cache") -> str:
+    """
+    Gets the Redis key of the cached sheet at `url`, see `get_sheet_dataframe`.
+    """
+    request_url = url.replace("edit#gid=", "export?format=csv&gid=")
+    return f"{cache_key}:{hashlib.sha1(request_url.encode()).hexdigest()}"
+
+
+def redis_set_cached_sheet(
+    dataframe: pd.DataFrame,
+    redis_client: RedisPal,
+    key: str,
+    etag: str = "",
+    last_modified: str = "",
+) -> None:
+    """
+    Caches a sheet in Redis as Parquet, see `get_sheet_dataframe`.
+    """
+    buffer = io.BytesIO()
+    dataframe.to_parquet(buffer, index=False)
+    redis_client.hset(
+        key,
+        mapping={
+            "data": buffer.getvalue(),
+            "etag": etag,
+            "last_modified": last_modified,
+            "fetched_at": time.time(),
+        },
+    )
+
+
+def get_sheet_dataframe(
+    url: str,
+    redis_client: RedisPal = None,
+    cache_key: str = "flooding_detection_sheet_cache",
+    ttl: int = 600,
+) -> pd.DataFrame:
     """
-    Downloads a file from a URL.
+    Downloads a Google Sheets tab as a DataFrame, caching it in Redis.
+
+    The parsed DataFrame is stored as Parquet together with the response ETag and
+    Last-Modified headers. Within `ttl` seconds of the last download the cached DataFrame is
+    returned without any request. After that, the download is revalidated with
+    If-None-Match / If-Modified-Since and the cached DataFrame is kept if the sheet didn't
+    change. If the download fails, a stale cached DataFrame is returned when available.
 
     Args:
-        url: The URL.
-        output_path: The output path.
+        url: The sheet URL, in the "edit#gid=" format.
+        redis_client: The Redis client. If `None`, the sheet is always downloaded.
+        cache_key: The Redis key prefix for the cache.
+        ttl: Number of seconds the cached sheet is used without revalidation.
 
     Returns:
-        Whether the file was downloaded successfully.
+        The sheet data.
     """
     request_url = url.replace("edit#gid=", "export?format=csv&gid=")
-    response = requests.get(request_url)
-    if response.status_code == 200:
-        dataframe = pd.read_csv(StringIO(response.content.decode("utf-8")))
-        dataframe.to_csv(output_path, index=False)
-        return True
-    return False
+    metrics = get_stage_metrics()
+    if redis_client is None:
+        with metrics.timer("sheet_download", downloaded=1):
+            response = requests.get(request_url)
+        if response.status_code != 200:
+            raise RuntimeError(f"Failed to download {request_url}: {response.status_code}")
+        return pd.read_csv(StringIO(response.content.decode("utf-8")))
+
+    key = get_sheet_cache_key(url, cache_key=cache_key)
+    cached = redis_client.hgetall(key)
+    if cached and time.time() - float(cached[b"fetched_at"]) < ttl:
+        log(f"Using cached sheet {request_url}.")
+        metrics.record("sheet_download", cache_hits=1)
+        return pd.read_parquet(io.BytesIO(cached[b"data"]))
+
+    headers = {}
+    if cached.get(b"etag"):
+        headers["If-None-Match"] = cached[b"etag"].decode()
+    if cached.get(b"last_modified"):
+        headers["If-Modified-Since"] = cached[b"last_modified"].decode()
+    try:
+        with metrics.timer("sheet_download"):
+            response = requests.get(request_url, headers=headers, timeout=30)
+    except requests.RequestException as exc:
+        metrics.record("sheet_download", failures=1)
+        if not cached:
+            raise
+        log(f"Failed to download {request_url}, using cached sheet: {exc}", level="warning")
+        return pd.read_parquet(io.BytesIO(cached[b"data"]))
+
+    if response.status_code == 304 and cached:
+        log(f"Sheet {request_url} not modified, using cached sheet.")
+        metrics.record("sheet_download", not_modified=1)
+        redis_client.hset(key, "fetched_at", time.time())
+        return pd.read_parquet(io.BytesIO(cached[b"data"]))
+    if response.status_code != 200:
+        metrics.record("sheet_download", failures=1)
+        if not cached:
+            raise RuntimeError(f"Failed to download {request_url}: {response.status_code}")
+        log(
+            f"Failed to download {request_url} ({response.status_code}), using cached sheet.",
+            level="warning",
+        )
+        return pd.read_parquet(io.BytesIO(cached[b"data"]))
+
+    dataframe = pd.read_csv(StringIO(response.content.decode("utf-8")))
+    metrics.record("sheet_download", downloaded=1)
+    redis_set_cached_sheet(
+        dataframe,
+        redis_client=redis_client,
+        key=key,
+        etag=response.headers.get("ETag", ""),
+        last_modified=response.headers.get("Last-Modified", ""),
+    )
+    return dataframe
+
+
+def build_multi_object_prompt(objects: List[ObjectParameters]) -> str:
+    """
+    Combines the prompts of many objects into a single prompt that asks for one JSON
+    answer with a label per object.
+
+    Args:
+        objects: The object parameters.
+
+    Returns:
+        The combined prompt.
+    """
+    sections = "\n\n".join(f'Object "{o.object}":\n{o.prompt}' for o in objects)
+    answer_format = ", ".join(f'"{o.object}": {{"label": true or false}}' for o in objects)
+    return (
+        "Evaluate the image for each of the objects below, following the instructions given "
+        f"for each one.\n\n{sections}\n\n"
+        "Ignore the answer format requested in the instructions above and answer with a single "
+        f"JSON object in the following format, and nothing else: {{{answer_format}}}"
+    )
+
+
+def parse_multi_object_response(text: str, objects: List[ObjectParameters]) -> Dict[str, bool]:
+    """
+    Splits the answer to a prompt built with `build_multi_object_prompt` into one label
+    per object.
+
+    Args:
+        text: The model response text.
+        objects: The object parameters used to build the prompt.
+
+    Returns:
+        A mapping from object name to label. Objects missing from the answer get `None`.
+    """
+    json_string = text.replace("```json\n", "").replace("\n```", "")
+    answer = json.loads(json_string)
+    labels = {}
+    for object_parameters in objects:
+        object_answer = answer.get(object_parameters.object)
+        if isinstance(object_answer, dict):
+            object_answer = object_answer.get("label")
+        labels[object_parameters.object] = object_answer
+    return labels
+
+
+@lru_cache(maxsize=16384)
+def get_h3_cell(latitude: float, longitude: float, resolution: int) -> str:
+    """
+    Gets the H3 cell containing a point. Cached, since cameras don't move.
 
+    Args:
+        latitude: The latitude.
+        longitude: The longitude.
+        resolution: The H3 resolution.
 
-def h3_id_to_polygon(h3_id: str):
+    Returns:
+        The H3 ID.
     """
-    Converts an H3 ID to a Polygon.
+    return h3.geo_to_h3(latitude, longitude, resolution)
+
+
+def get_h3_index(
+    latitudes: Iterable[float], longitudes: Iterable[float], resolution: int
+) -> List[str]:
+    """
+    Gets the H3 cell of each point, so points can be joined to H3 data with a hash lookup
+    instead of a polygon spatial join.
 
     Args:
-        h3_id: The H3 ID.
+        latitudes: The latitudes.
+        longitudes: The longitudes.
+        resolution: The H3 resolution.
 
     Returns:
-        The Polygon.
+        The H3 IDs.
     """
-    return Polygon(h3.h3_to_geo_boundary(h3_id, geo_json=True))
+    return [
+        get_h3_cell(latitude, longitude, resolution)
+        for latitude, longitude in zip(latitudes, longitudes)
+    ]
 
 
 def extract_data(row: Dict[str, Any]) -> pd.Series:
@@ -200,50 +1153,104 @@ def get_cameras_h3(df: pd.DataFrame) -> gpd.GeoDataFrame:
 
     pluviometro = get_rain_dataframe()
     pluviometro = pluviometro.rename(columns={"status": "status_chuva"})
-    geometry = pluviometro["id_h3"].apply(lambda h3_id: h3_id_to_polygon(h3_id))
-    pluviometro_geo = gpd.GeoDataFrame(pluviometro, geometry=geometry)
-    pluviometro_geo.crs = {"init": "epsg:4326"}
-    print("pluviometro_geo:", pluviometro_geo.shape)
-
-    cameras_h3 = gpd.sjoin(cameras_geo, pluviometro_geo, how="left", op="within")
-    cameras_h3 = cameras_h3.drop(columns=["index_right"])
-    cameras_h3 = cameras_h3[cameras_h3["id_h3"].notnull()]
+    print("pluviometro:", pluviometro.shape)
+
+    # Only cameras inside a rain hexagon are kept, so none are without rain data
+    if len(pluviometro) == 0:
+        log("No rain data, no cameras inside a rain hexagon.", level="warning")
+        return cameras_geo.iloc[0:0].assign(id_h3=None)
+    cameras_geo["id_h3"] = get_h3_index(
+        cameras_geo["latitude"],
+        cameras_geo["longitude"],
+        resolution=h3.h3_get_resolution(pluviometro["id_h3"].iloc[0]),
+    )
+    cameras_h3 = cameras_geo.merge(pluviometro, how="inner", on="id_h3")
 
     return cameras_h3
 
 
-def get_cameras_h3_bolsao(cameras_h3: gpd.GeoDataFrame, buffer: int = 0.002):
+def query_points_within_distance(
+    latitudes: Iterable[float],
+    longitudes: Iterable[float],
+    target_latitudes: Iterable[float],
+    target_longitudes: Iterable[float],
+    radius_m: float,
+    projected_crs: str = "EPSG:31983",
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Finds, for every point, the target points within `radius_m` meters, using an STRtree on
+    projected coordinates.
+
+    Args:
+        latitudes: The points latitudes.
+        longitudes: The points longitudes.
+        target_latitudes: The target points latitudes.
+        target_longitudes: The target points longitudes.
+        radius_m: The search radius, in meters.
+        projected_crs: A metric CRS for the area. Defaults to SIRGAS 2000 / UTM 23S (Rio).
+
+    Returns:
+        Three arrays of the same length, one entry per (point, target) pair within the
+        radius: the point positions, the target positions and their distances in meters.
+    """
+    transformer = pyproj.Transformer.from_crs("EPSG:4326", projected_crs, always_xy=True)
+    x, y = transformer.transform(np.asarray(longitudes), np.asarray(latitudes))
+    target_x, target_y = transformer.transform(
+        np.asarray(target_longitudes), np.asarray(target_latitudes)
+    )
+    tree = STRtree(shapely.points(target_x, target_y))
+    point_index, target_index = tree.query(
+        shapely.points(x, y), predicate="dwithin", distance=radius_m
+    )
+    distances = np.hypot(
+        x[point_index] - target_x[target_index], y[point_index] - target_y[target_index]
+    )
+    return point_index, target_index, distances
+
+
+def get_cameras_h3_bolsao(cameras_h3: gpd.GeoDataFrame, radius_m: float = 200):
     """
     Enhances camera data with geographical information and joins it with flood pocket data.
 
     Parameters:
     - cameras_h3 (gpd.GeoDataFrame): A GeoDataFrame containing camera and h3 data.
-    - buffer (int): A radius buffer around the flood pocket point.
+    - radius_m (float): The maximum distance, in meters, between a camera and a flood pocket.
 
     Returns:
-    - gpd.GeoDataFrame: A GeoDataFrame containing the joined camera, rainfall and flood pocket data.
+    - gpd.GeoDataFrame: A GeoDataFrame containing the joined camera, rainfall and flood pocket
+      data, with one row per camera and flood pocket within `radius_m` (nearest first) and the
+      distance between them in "distancia_bolsao_m".
     """
 
     bolsao = pd.read_excel("./data/PLANILHAO_PDS_alimentaBI.xlsx")
     bolsao.columns = remove_columns_accents(bolsao)
     cols = ["codigo", "lat", "long", "classe_atual", "bacia", "sub_bacia"]
-    bolsao = bolsao[cols]
-
-    geometry = [Point(xy) for xy in zip(bolsao["long"], bolsao["lat"])]
-    bolsao_geo = gpd.GeoDataFrame(bolsao, geometry=geometry)
-    bolsao_geo.crs = {"init": "epsg:4326"}
-    bolsao_geo["geometry"] = bolsao_geo["geometry"].buffer(buffer)
-    bolsao_geo.insert(0, "is_bolsao", True)
-
-    cameras_bolsao_h3 = gpd.sjoin(cameras_h3, bolsao_geo, how="left", op="within")
+    bolsao = bolsao[cols].reset_index(drop=True)
+    bolsao.insert(0, "is_bolsao", True)
 
-    cameras_bolsao_h3["geometry_bolsao_buffer_0.002"] = [
-        Point(xy).buffer(buffer) for xy in zip(cameras_bolsao_h3["long"], cameras_bolsao_h3["lat"])
-    ]
-    cameras_bolsao_h3["geometry_bolsao_buffer_0.002"] = cameras_bolsao_h3[
-        f"geometry_bolsao_buffer_{buffer}"
-    ].apply(lambda x: np.nan if x.is_empty else x)
-    cameras_bolsao_h3 = cameras_bolsao_h3.drop(columns=["index_right"])
+    cameras_h3 = cameras_h3.reset_index(drop=True)
+    camera_index, bolsao_index, distances = query_points_within_distance(
+        cameras_h3["latitude"],
+        cameras_h3["longitude"],
+        bolsao["lat"],
+        bolsao["long"],
+        radius_m=radius_m,
+    )
+    pairs = pd.DataFrame(
+        {
+            "camera_index": camera_index,
+            "bolsao_index": bolsao_index,
+            "distancia_bolsao_m": distances,
+        }
+    ).sort_values(["camera_index", "distancia_bolsao_m"])
+
+    cameras_bolsao_h3 = cameras_h3.merge(
+        pairs, how="left", left_index=True, right_on="camera_index"
+    )
+    cameras_bolsao_h3 = cameras_bolsao_h3.merge(
+        bolsao, how="left", left_on="bolsao_index", right_index=True
+    )
+    cameras_bolsao_h3 = cameras_bolsao_h3.drop(columns=["camera_index", "bolsao_index"])
 
     rename_bolsao_cols = {
         "codigo": "id_bolsao",
@@ -254,7 +1261,7 @@ def get_cameras_h3_bolsao(cameras_h3: gpd.GeoDataFrame, buffer: int = 0.002):
 
     cameras_bolsao_h3 = cameras_bolsao_h3.rename(columns=rename_bolsao_cols)
 
-    return cameras_bolsao_h3
+    return cameras_bolsao_h3.reset_index(drop=True)
 
 
 def clean_and_padronize_cameras() -> gpd.GeoDataFrame:
@@ -307,49 +1314,1087 @@ def clean_and_padronize_cameras() -> gpd.GeoDataFrame:
     cameras_h3 = cameras_h3.reset_index(drop=True)
     log("cameras_h3: ", cameras_h3.shape)
 
-    cameras_h3_bolsao = get_cameras_h3_bolsao(cameras_h3, buffer=0.002)
-    # remove duplicate bolsoes
+    cameras_h3_bolsao = get_cameras_h3_bolsao(cameras_h3, radius_m=200)
+    # remove duplicate bolsoes, keeping the nearest one
     cameras_h3_bolsao = cameras_h3_bolsao.drop_duplicates(subset="id_camera")
     log("cameras_h3_bolsao: ", cameras_h3_bolsao.shape)
     log("is_bolsao: ", cameras_h3_bolsao["is_bolsao"].sum())
     return cameras_h3_bolsao.reset_index(drop=True)
 
 
-def redis_add_to_prediction_buffer(
-    key: str, value: bool, redis_client: RedisPal, len_: int = 3
-) -> List[bool]:
+def get_prediction_buffer_key(predictions_buffer_key: str, id_camera: str, object_name: str) -> str:
+    """
+    Gets the Redis key of the predictions buffer of a camera and object.
+    """
+    return f"{predictions_buffer_key}:{id_camera}:{object_name}"
+
+
+def _decode_prediction_buffer(values: List[bytes], len_: int) -> List[bool]:
+    prediction_buffer = [json.loads(value) for value in values]
+    if len(prediction_buffer) < len_:
+        return [False] * (len_ - len(prediction_buffer)) + prediction_buffer
+    return prediction_buffer
+
+
+def redis_add_to_prediction_buffers(
+    values: Dict[str, bool], redis_client: RedisPal, len_: int = 3
+) -> Dict[str, List[bool]]:
     """
-    Adds a value to the prediction buffer in Redis.
+    Appends values to many prediction buffers in Redis, atomically and in a single round
+    trip. Each buffer is a Redis list trimmed to its last `len_` values.
 
     Args:
-        key: The Redis key.
-        value: The value to be added.
-        len: The length of the buffer.
+        values: A mapping from Redis key to the value to be added.
+        len_: The length of the buffers.
+
+    Returns:
+        A mapping from Redis key to the updated prediction buffer.
     """
-    prediction_buffer = redis_get_prediction_buffer(key, len_=len_, redis_client=redis_client)
-    prediction_buffer.append(value)
-    prediction_buffer = prediction_buffer[-len_:]
-    redis_client.set(key, prediction_buffer)
-    return prediction_buffer
+    if not values:
+        return {}
+    pipeline = redis_client.pipeline(transaction=True)
+    for key, value in values.items():
+        pipeline.rpush(key, json.dumps(value))
+        pipeline.ltrim(key, -len_, -1)
+        pipeline.lrange(key, -len_, -1)
+    results = pipeline.execute()
+    return {
+        key: _decode_prediction_buffer(buffer_values, len_)
+        for key, buffer_values in zip(values, results[2::3])
+    }
 
 
-def redis_get_prediction_buffer(key: str, redis_client: RedisPal, len_: int = 3) -> List[bool]:
+def redis_get_prediction_buffers(
+    keys: List[str], redis_client: RedisPal, len_: int = 3
+) -> Dict[str, List[bool]]:
     """
-    Gets the prediction buffer from Redis.
+    Gets many prediction buffers from Redis in a single round trip.
+
+    Args:
+        keys: The Redis keys.
+        len_: The length of the buffers.
+
+    Returns:
+        A mapping from Redis key to prediction buffer, padded with `False` when shorter
+        than `len_`.
+    """
+    if not keys:
+        return {}
+    pipeline = redis_client.pipeline(transaction=False)
+    for key in keys:
+        pipeline.lrange(key, -len_, -1)
+    results = pipeline.execute()
+    return {
+        key: _decode_prediction_buffer(buffer_values, len_)
+        for key, buffer_values in zip(keys, results)
+    }
+
+
+RAIN_STATUS_PRIORITY = {
+    "sem chuva": 0,
+    "chuva fraca": 1,
+    "chuva moderada": 2,
+    "chuva forte": 3,
+    "chuva muito forte": 4,
+}
+
+
+def get_camera_priority(
+    status: pd.Series,
+    is_bolsao: pd.Series,
+    has_positive_buffer: pd.Series,
+    seconds_since_last_check: pd.Series,
+    revisit_interval: float = 1800,
+) -> pd.Series:
+    """
+    Scores cameras for scheduling, the higher the sooner they should be checked.
+
+    Each level of rain intensity in the camera hexagon is worth 2 points, a recent positive
+    prediction 4 points and being close to a bolsão 1 point. On top of that, every
+    `revisit_interval` seconds since the last check adds 1 point, so cameras with no rain
+    are still visited round-robin, just at a slower cadence. Cameras never checked come
+    first.
+
+    Args:
+        status: The rain status of each camera hexagon.
+        is_bolsao: Whether each camera is close to a bolsão.
+        has_positive_buffer: Whether each camera had a recent positive prediction.
+        seconds_since_last_check: Seconds since each camera was last checked, NaN if never.
+        revisit_interval: Number of seconds worth one priority point.
+
+    Returns:
+        The priority of each camera.
+    """
+    rain_priority = status.map(RAIN_STATUS_PRIORITY).fillna(0)
+    age_priority = (seconds_since_last_check / revisit_interval).fillna(np.inf)
+    return (
+        2 * rain_priority
+        + 4 * has_positive_buffer.astype("boolean").fillna(False).astype(int)
+        + is_bolsao.astype("boolean").fillna(False).astype(int)
+        + age_priority
+    )
+
+
+def redis_get_last_checks(
+    id_cameras: List[str], redis_client: RedisPal, last_check_key: str
+) -> Dict[str, float]:
+    """
+    Gets the timestamp of the last check of many cameras from a Redis hash.
+
+    Returns:
+        A mapping from camera ID to timestamp, for cameras that were checked before.
+    """
+    if not id_cameras:
+        return {}
+    values = redis_client.hmget(last_check_key, id_cameras)
+    return {
+        id_camera: float(value) for id_camera, value in zip(id_cameras, values) if value is not None
+    }
+
+
+def redis_set_last_checks(
+    id_cameras: List[str], redis_client: RedisPal, last_check_key: str, timestamp: float
+) -> None:
+    """
+    Sets the timestamp of the last check of many cameras in a Redis hash.
+    """
+    if not id_cameras:
+        return
+    redis_client.hset(last_check_key, mapping={id_camera: timestamp for id_camera in id_cameras})
+
+
+def redis_get_camera_health(
+    id_cameras: List[str], redis_client: RedisPal, health_key: str
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Gets the capture health of many cameras from a Redis hash, see `redis_record_capture`.
+
+    Returns:
+        A mapping from camera ID to health, for cameras that were captured before.
+    """
+    if not id_cameras:
+        return {}
+    values = redis_client.hmget(health_key, id_cameras)
+    return {
+        id_camera: json.loads(value)
+        for id_camera, value in zip(id_cameras, values)
+        if value is not None
+    }
+
+
+def redis_record_capture(
+    id_camera: str,
+    redis_client: RedisPal,
+    health_key: str,
+    success: bool,
+    latency: float = None,
+    failure_threshold: int = 3,
+    backoff_base: float = 300,
+    backoff_max: float = 3600,
+) -> Dict[str, Any]:
+    """
+    Records the outcome of a capture in the camera health hash.
+
+    Each camera keeps its number of consecutive failures, the timestamps of its last success
+    and failure, and the moving average of its successful capture latency. After
+    `failure_threshold` consecutive failures its circuit is opened until `open_until`, for
+    `backoff_base` seconds doubling on each new failure up to `backoff_max`. Once that time
+    has passed the camera is tried again, and a success closes the circuit.
+
+    The read and write are a single transaction (WATCH/MULTI), retried if the hash changes
+    in between, so concurrent captures don't overwrite each other's outcome.
+
+    Returns:
+        The camera health.
+    """
+
+    def update_health(pipeline) -> Dict[str, Any]:
+        value = pipeline.hget(health_key, id_camera)
+        health = json.loads(value) if value is not None else {}
+        now = time.time()
+        if success:
+            health["failures"] = 0
+            health["last_success"] = now
+            health["open_until"] = None
+            if latency is not None:
+                mean_latency = health.get("mean_latency")
+                health["mean_latency"] = (
+                    latency if mean_latency is None else 0.8 * mean_latency + 0.2 * latency
+                )
+        else:
+            health["failures"] = health.get("failures", 0) + 1
+            health["last_failure"] = now
+            if health["failures"] >= failure_threshold:
+                backoff = backoff_base * 2 ** (health["failures"] - failure_threshold)
+                health["open_until"] = now + min(backoff, backoff_max)
+        pipeline.multi()
+        pipeline.hset(health_key, id_camera, json.dumps(health))
+        return health
+
+    health = redis_client.transaction(update_health, health_key, value_from_callable=True)
+    if not success and health.get("open_until") is not None:
+        log(
+            f"Circuit open for camera {id_camera} after {health['failures']} failures, "
+            f"until {pendulum.from_timestamp(health['open_until']).to_datetime_string()}.",
+            level="warning",
+        )
+    return health
+
+
+def is_circuit_open(health: Dict[str, Any], now: float = None) -> bool:
+    """
+    Whether a camera should not be captured now, see `redis_record_capture`.
+    """
+    open_until = health.get("open_until")
+    return open_until is not None and open_until > (now or time.time())
+
+
+class FloodingDataPublisher:
+    """
+    Publishes the flooding detection API data camera by camera, as soon as each camera is
+    classified, instead of once the whole cycle is done.
+
+    The API entry of each camera is written to the Redis hash `{data_key}:cameras`. At most
+    every `min_interval` seconds, and on `flush`, the API data of all cameras of the cycle
+    is rebuilt from that hash and swapped in atomically, together with the last update key.
+    Cameras of the cycle that aren't classified (not scheduled or dropped at the deadline)
+    are published with `None` labels, so no stale label is served, and cameras with an open
+    circuit are removed since their streams are down.
+    """
+
+    def __init__(
+        self,
+        redis_client: RedisPal,
+        data_key: str,
+        last_update_key: str,
+        predictions_buffer_key: str,
+        id_cameras: List[str],
+        min_interval: float = 5,
+    ):
+        self.redis_client = redis_client
+        self.data_key = data_key
+        self.last_update_key = last_update_key
+        self.predictions_buffer_key = predictions_buffer_key
+        self.cameras_key = f"{data_key}:cameras"
+        self.id_cameras = list(id_cameras)
+        self.min_interval = min_interval
+        self.published = set()
+        self.records = []
+        self._last_flush = time.time()
+        self._lock = threading.Lock()
+
+    def publish(self, cameras_with_image_and_classification: List[CameraRecord]) -> None:
+        """
+        Updates the predictions buffers and publishes the API entries of the cameras, in one
+        round trip each. Cameras not attempted in this cycle are published with `None`
+        labels, keeping the image of their previous entry if they have no new one, and the
+        entries of cameras with an open circuit are removed.
+
+        The published label of each object is the most common label of its predictions
+        buffer. The classifications keep the label given by the model, and the classified
+        cameras are kept in `records`.
+        """
+        circuit_open = [
+            camera.id_camera
+            for camera in cameras_with_image_and_classification
+            if camera.circuit_open
+        ]
+        if circuit_open:
+            self.redis_client.hdel(self.cameras_key, *circuit_open)
+        cameras = [
+            camera for camera in cameras_with_image_and_classification if not camera.circuit_open
+        ]
+        if not cameras:
+            return
+        classified_cameras = [camera for camera in cameras if camera.attempt_classification]
+        start_time = time.perf_counter()
+        now = pendulum.now(tz="America/Sao_Paulo").to_datetime_string()
+
+        current_predictions = {
+            get_prediction_buffer_key(
+                self.predictions_buffer_key, camera.id_camera, classification.object
+            ): classification.label
+            for camera in classified_cameras
+            for classification in camera.ai_classification
+            if classification.label is not None
+        }
+        predictions_buffers = redis_add_to_prediction_buffers(
+            current_predictions, redis_client=self.redis_client
+        )
+        without_image = [
+            camera.id_camera
+            for camera in cameras
+            if not camera.attempt_classification and camera.image_url is None
+        ]
+        previous_image_urls = {}
+        if without_image:
+            values = self.redis_client.hmget(self.cameras_key, without_image)
+            previous_image_urls = {
+                id_camera: RedisPal._deserialize(value).get("image_url")
+                for id_camera, value in zip(without_image, values)
+                if value is not None
+            }
+
+        api_entries = {}
+        for camera in cameras:
+            if camera.attempt_classification:
+                camera.datetime = now
+                classifications = []
+                for classification in camera.ai_classification:
+                    label, confidence = None, None
+                    if classification.label is not None:
+                        # Get most common prediction
+                        predictions_buffer = predictions_buffers[
+                            get_prediction_buffer_key(
+                                self.predictions_buffer_key, camera.id_camera, classification.object
+                            )
+                        ]
+                        label = max(set(predictions_buffer), key=predictions_buffer.count)
+                        confidence = classification.confidence
+                    classifications.append(
+                        {
+                            "object": classification.object,
+                            "label": label,
+                            "confidence": confidence,
+                        }
+                    )
+            else:
+                classifications = [
+                    {"object": o.object, "label": None, "confidence": None} for o in camera.objects
+                ]
+            api_entries[camera.id_camera] = RedisPal._serialize(
+                {
+                    "datetime": now,
+                    "id_camera": camera.id_camera,
+                    "url_camera": camera.url_camera,
+                    "latitude": camera.latitude,
+                    "longitude": camera.longitude,
+                    "image_url": camera.image_url or previous_image_urls.get(camera.id_camera),
+                    "ai_classification": classifications,
+                }
+            )
+        self.redis_client.hset(self.cameras_key, mapping=api_entries)
+        get_stage_metrics().record(
+            "redis_publish", seconds=time.perf_counter() - start_time, cameras=len(cameras)
+        )
+
+        with self._lock:
+            self.published.update(api_entries)
+            self.records.extend(classified_cameras)
+            should_flush = time.time() - self._last_flush >= self.min_interval
+        if should_flush:
+            self.flush()
+
+    def flush(self) -> List[Dict[str, Any]]:
+        """
+        Rebuilds the API data from the published entries of the cameras of the cycle and
+        swaps it in atomically, together with the last update datetime (now).
+
+        Returns:
+            The API data.
+        """
+        start_time = time.perf_counter()
+        with self._lock:
+            self._last_flush = time.time()
+        values = (
+            self.redis_client.hmget(self.cameras_key, self.id_cameras) if self.id_cameras else []
+        )
+        api_data = [RedisPal._deserialize(value) for value in values if value is not None]
+        last_update = pendulum.now(tz="America/Sao_Paulo").to_datetime_string()
+
+        # Same layout as `RedisPal.set`, in a single transaction
+        timestamp = time.time()
+        pipeline = self.redis_client.pipeline(transaction=True)
+        pipeline.set(self.data_key, RedisPal._serialize(api_data))
+        pipeline.set(f"{self.data_key}_timestamp", timestamp)
+        pipeline.set(self.last_update_key, RedisPal._serialize(last_update))
+        pipeline.set(f"{self.last_update_key}_timestamp", timestamp)
+        pipeline.execute()
+        get_stage_metrics().record("redis_flush", seconds=time.perf_counter() - start_time)
+        log(f"Published flooding detection data of {len(api_data)} cameras.")
+        return api_data
+
+
+def api_data_to_dataframe(api_data: List[CameraRecord], api_model: str) -> pd.DataFrame:
+    """
+    Builds the typed BigQuery rows of the published cameras, one row per classification.
+    Images are referenced by their archive URI, never embedded.
+    """
+    # One row per classification, so cameras with many objects get many rows
+    data_normalized = []
+    for camera in api_data:
+        camera_dict = {
+            "datetime": camera.datetime,
+            "id_camera": camera.id_camera,
+            "url_camera": camera.url_camera,
+            "latitude": camera.latitude,
+            "longitude": camera.longitude,
+            "image_url": camera.image_url,
+            "image_uri": camera.image_uri,
+        }
+        if len(camera.ai_classification) == 0:
+            data_normalized.append(camera_dict)
+        for classification in camera.ai_classification:
+            data_normalized.append(
+                camera_dict
+                | {
+                    "object": classification.object,
+                    "label": classification.label,
+                    "confidence": classification.confidence,
+                    "source": classification.source,
+                    "prompt": classification.parameters.prompt,
+                    "max_output_token": classification.parameters.max_output_token,
+                    "temperature": classification.parameters.temperature,
+                    "top_k": classification.parameters.top_k,
+                    "top_p": classification.parameters.top_p,
+                }
+            )
+    dataframe = pd.DataFrame.from_records(data_normalized)
+    dataframe["model"] = api_model
+    dtypes = {
+        "datetime": "datetime64[ns]",
+        "id_camera": "string",
+        "url_camera": "string",
+        "latitude": "float64",
+        "longitude": "float64",
+        "image_url": "string",
+        "image_uri": "string",
+        "object": "string",
+        "label": "boolean",
+        "confidence": "float64",
+        "source": "string",
+        "prompt": "string",
+        "max_output_token": "Int64",
+        "temperature": "float64",
+        "top_k": "Int64",
+        "top_p": "float64",
+        "model": "string",
+    }
+    return dataframe.astype(
+        {column: dtype for column, dtype in dtypes.items() if column in dataframe.columns}
+    )
+
+
+class PredictionSpool:
+    """
+    Buffers the BigQuery rows of many cycles in a Redis list, so they're loaded in a single
+    batch every `flush_interval` seconds or `flush_rows` rows instead of once per cycle.
+
+    Each cycle appends its rows to the list `spool_key`. A due batch is claimed by renaming
+    the list to `{spool_key}:flushing`, which new cycles don't touch, and is only deleted by
+    `ack` once it's loaded. A batch left over by a failed run is claimed again, as is, by
+    the next one.
+    """
+
+    def __init__(
+        self,
+        redis_client: RedisPal,
+        spool_key: str,
+        flush_interval: float = 900,
+        flush_rows: int = 5000,
+    ):
+        self.redis_client = redis_client
+        self.spool_key = spool_key
+        self.flushing_key = f"{spool_key}:flushing"
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+
+    def append(self, dataframe: pd.DataFrame) -> None:
+        """
+        Appends the rows of a cycle to the spool.
+        """
+        if dataframe.empty:
+            return
+        self.redis_client.rpush(self.spool_key, RedisPal._serialize((time.time(), dataframe)))
+
+    def _read(self, key: str) -> List[Tuple[float, pd.DataFrame]]:
+        return [RedisPal._deserialize(value) for value in self.redis_client.lrange(key, 0, -1)]
+
+    def claim(self) -> Tuple[pd.DataFrame, str]:
+        """
+        Claims the batch to be loaded: the one left over by a failed run, if any, or the
+        spooled rows if they're due.
+
+        Returns:
+            The rows of the batch, or `None` if there's nothing to load, and the batch ID,
+            which is the same if the batch is claimed again.
+        """
+        entries = self._read(self.flushing_key)
+        if entries:
+            log(f"Replaying unacknowledged batch of {len(entries)} cycles.", level="warning")
+        else:
+            entries = self._read(self.spool_key)
+            if not entries:
+                return None, None
+            rows = sum(len(dataframe) for _, dataframe in entries)
+            age = time.time() - entries[0][0]
+            if rows < self.flush_rows and age < self.flush_interval:
+                log(f"Spooled {rows} rows of {len(entries)} cycles, oldest {round(age)}s ago.")
+                return None, None
+            # Cycles spooled meanwhile are renamed too, so re-read the claimed batch
+            self.redis_client.rename(self.spool_key, self.flushing_key)
+            entries = self._read(self.flushing_key)
+        batch_id = pendulum.from_timestamp(entries[0][0]).format("YYYYMMDD-HHmmss")
+        dataframe = pd.concat([dataframe for _, dataframe in entries], ignore_index=True)
+        log(f"Claimed batch {batch_id} with {len(dataframe)} rows of {len(entries)} cycles.")
+        return dataframe, batch_id
+
+    def ack(self) -> None:
+        """
+        Deletes the claimed batch, once it's loaded.
+        """
+        self.redis_client.delete(self.flushing_key)
+
+
+def get_perceptual_hash(image: np.ndarray, hash_size: int = 8) -> int:
+    """
+    Computes the DCT perceptual hash of an image.
+
+    Args:
+        image: The image, either grayscale or BGR.
+        hash_size: The hash side, the hash has `hash_size ** 2` bits.
+
+    Returns:
+        The hash as an integer.
+    """
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    side = hash_size * 4
+    resized = cv2.resize(image, (side, side), interpolation=cv2.INTER_AREA).astype(np.float32)
+    dct = cv2.dct(resized)[:hash_size, :hash_size]
+    bits = (dct > np.median(dct)).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming_distance(hash_a: int, hash_b: int) -> int:
+    """
+    Counts the bits that differ between two hashes.
+    """
+    return bin(hash_a ^ hash_b).count("1")
+
+
+def get_prediction_parameters_hash(
+    google_api_model: str, object_parameters: ObjectParameters
+) -> str:
+    """
+    Hashes the model and object parameters (prompt and generation config) of a prediction,
+    so cached predictions are invalidated whenever any of them changes.
+    """
+    parameters = {
+        "model": google_api_model,
+        "prompt": object_parameters.prompt,
+        "max_output_token": object_parameters.max_output_token,
+        "temperature": object_parameters.temperature,
+        "top_k": object_parameters.top_k,
+        "top_p": object_parameters.top_p,
+    }
+    return hashlib.sha256(json.dumps(parameters, default=str).encode()).hexdigest()
+
+
+def get_generation_request_hash(
+    model_name: str, contents: List[Any], generation_config: Dict[str, Any]
+) -> str:
+    """
+    Hashes everything sent to the model in a request: the model, the generation config and
+    every content (prompts and image bytes), so only identical requests share a hash.
+    """
+    digest = hashlib.sha256()
+    header = json.dumps(
+        {"model": model_name, "generation_config": generation_config},
+        sort_keys=True,
+        default=str,
+    )
+    parts = [header.encode()]
+    for content in contents:
+        if isinstance(content, dict):
+            parts += [content["mime_type"].encode(), content["data"]]
+        else:
+            parts.append(str(content).encode())
+    for part in parts:
+        # Length-prefixed, so parts can't run into each other
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def redis_get_cached_prediction(
+    key: str,
+    image_hash: int,
+    parameters_hash: str,
+    max_distance: int,
+    redis_client: RedisPal,
+) -> Union[bool, None]:
+    """
+    Gets a cached prediction from Redis if it was made on a similar frame with the same
+    parameters.
 
     Args:
         key: The Redis key.
-        len: The length of the buffer.
+        image_hash: The perceptual hash of the current frame.
+        parameters_hash: The hash of the current prediction parameters.
+        max_distance: The maximum Hamming distance between frame hashes to reuse the label.
 
     Returns:
-        The prediction buffer.
-    """
-    prediction_buffer = redis_client.get(key)
-    if prediction_buffer is None:
-        return [False] * len_
-    elif not isinstance(prediction_buffer, list):
-        return [False] * len_
-    elif len(prediction_buffer) < len_:
-        diff = len_ - len(prediction_buffer)
-        return [False] * diff + prediction_buffer
-    return prediction_buffer
+        The cached label, or `None` if there's no usable cached prediction.
+    """
+    cached_prediction = redis_client.get(key)
+    if not isinstance(cached_prediction, dict):
+        return None
+    if cached_prediction.get("parameters_hash") != parameters_hash:
+        return None
+    if hamming_distance(cached_prediction["image_hash"], image_hash) > max_distance:
+        return None
+    return cached_prediction["label"]
+
+
+def redis_set_cached_prediction(
+    key: str,
+    image_hash: int,
+    parameters_hash: str,
+    label: bool,
+    redis_client: RedisPal,
+    ttl: int = 900,
+) -> None:
+    """
+    Caches a prediction in Redis.
+
+    Args:
+        key: The Redis key.
+        image_hash: The perceptual hash of the frame.
+        parameters_hash: The hash of the prediction parameters.
+        label: The predicted label.
+        ttl: Number of seconds the prediction can be reused for.
+    """
+    redis_client.set(
+        key,
+        {"image_hash": image_hash, "parameters_hash": parameters_hash, "label": label},
+        ex=ttl,
+    )
+
+
+def get_prefilter_features(
+    frame: np.ndarray, previous_thumbnail: np.ndarray = None
+) -> Dict[str, float]:
+    """
+    Computes cheap image features used to decide whether a frame needs the remote model.
+
+    Args:
+        frame: The frame, in BGR.
+        previous_thumbnail: The grayscale thumbnail of the previous frame of the same camera,
+            as returned in the "thumbnail" key. Used for the frame difference.
+
+    Returns:
+        A dictionary with:
+            - "brightness": mean intensity, from 0 to 1.
+            - "sharpness": variance of the Laplacian (low values mean blur or a wet lens).
+            - "water_texture": fraction of the lower half of the frame that is smooth, bright
+              and unsaturated, like water reflecting the sky.
+            - "frame_difference": mean absolute difference to the previous frame, from 0 to
+              1, or `None` when there's no previous frame.
+            - "thumbnail": the grayscale thumbnail of this frame.
+    """
+    frame = cv2.resize(frame, (320, 240), interpolation=cv2.INTER_AREA)
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    saturation = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)[:, :, 1]
+
+    gradient = cv2.magnitude(
+        cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3), cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3)
+    )
+    gradient = cv2.blur(gradient, (5, 5))
+    lower_half = slice(gray.shape[0] // 2, None)
+    water_like = (
+        (gradient[lower_half] < 20) & (gray[lower_half] > 90) & (saturation[lower_half] < 60)
+    )
+
+    thumbnail = cv2.resize(gray, (64, 48), interpolation=cv2.INTER_AREA)
+    frame_difference = None
+    if previous_thumbnail is not None and previous_thumbnail.shape == thumbnail.shape:
+        frame_difference = float(cv2.absdiff(thumbnail, previous_thumbnail).mean() / 255)
+
+    return {
+        "brightness": float(gray.mean() / 255),
+        "sharpness": float(cv2.Laplacian(gray, cv2.CV_64F).var()),
+        "water_texture": float(water_like.mean()),
+        "frame_difference": frame_difference,
+        "thumbnail": thumbnail,
+    }
+
+
+def is_prefilter_uncertain(
+    features: Dict[str, float],
+    min_brightness: float = 0.15,
+    min_sharpness: float = 50,
+    max_frame_difference: float = 0.2,
+) -> bool:
+    """
+    Tells whether the local features can't be trusted for this frame (too dark, too blurry
+    or changed too much since the previous frame), so it must go to the remote model.
+    """
+    if features["brightness"] < min_brightness:
+        return True
+    if features["sharpness"] < min_sharpness:
+        return True
+    if (
+        features["frame_difference"] is not None
+        and features["frame_difference"] > max_frame_difference
+    ):
+        return True
+    return False
+
+
+class TokenBucket:
+    """
+    Asyncio token bucket: allows bursts of up to `capacity` requests and `rate` requests
+    per second on average.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens: float = 1) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated_at) * self.rate
+                )
+                self._updated_at = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+
+class GeminiClassifier:
+    """
+    Holds one configured Gemini model and sends requests to it concurrently, under a token
+    bucket matching the API quota, retrying rate limits and transient errors with jittered
+    exponential backoff.
+
+    When a Redis client is given and `memo_ttl` is positive, responses are memoized for
+    `memo_ttl` seconds under `{memo_key}:{hash}`, where the hash covers the whole request
+    (see `get_generation_request_hash`), so an identical request is answered without
+    calling the model. Hits and misses are counted in the "model_memo" stage metrics.
+    """
+
+    RETRYABLE_EXCEPTIONS = (
+        google_exceptions.ResourceExhausted,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.InternalServerError,
+    )
+
+    def __init__(
+        self,
+        api_key: str,
+        model_name: str,
+        requests_per_minute: float = 60,
+        max_concurrency: int = 20,
+        max_retries: int = 5,
+        backoff_base: float = 1,
+        backoff_max: float = 30,
+        redis_client: RedisPal = None,
+        memo_key: str = "flooding_detection_prediction_memo",
+        memo_ttl: int = 0,
+        model: Any = None,
+    ):
+        # A given model (with the `generate_content_async` method) is used as is
+        if model is None:
+            genai.configure(api_key=api_key)
+            model = genai.GenerativeModel(model_name)
+        self.model_name = model_name
+        self.model = model
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.redis_client = redis_client
+        self.memo_key = memo_key
+        self.memo_ttl = memo_ttl
+        self._bucket = TokenBucket(rate=requests_per_minute / 60)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def generate(self, contents: List[Any], generation_config: Dict[str, Any]) -> str:
+        """
+        Sends a request to the model.
+
+        Args:
+            contents: The request contents (prompt and image).
+            generation_config: The generation config.
+
+        Returns:
+            The response text.
+        """
+        metrics = get_stage_metrics()
+        use_memo = self.redis_client is not None and self.memo_ttl > 0
+        if use_memo:
+            memo_key = f"{self.memo_key}:" + get_generation_request_hash(
+                self.model_name, contents, generation_config
+            )
+            loop = asyncio.get_running_loop()
+            text = await loop.run_in_executor(None, self.redis_client.get, memo_key)
+            if text is not None:
+                metrics.record("model_memo", hits=1)
+                return text
+            metrics.record("model_memo", misses=1)
+        for attempt in range(self.max_retries + 1):
+            with metrics.timer("model_rate_limit"):
+                await self._bucket.acquire()
+            try:
+                async with self._semaphore:
+                    with metrics.timer("model_call"):
+                        response = await self.model.generate_content_async(
+                            contents=contents, generation_config=generation_config
+                        )
+                text = response.text
+                if use_memo:
+                    await loop.run_in_executor(
+                        None, partial(self.redis_client.set, memo_key, text, ex=self.memo_ttl)
+                    )
+                return text
+            except self.RETRYABLE_EXCEPTIONS as exc:
+                if attempt == self.max_retries:
+                    raise
+                metrics.record("model_call", retries=1)
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+                log(f"Retrying Gemini request in {delay:.1f}s after: {exc}", level="warning")
+                await asyncio.sleep(delay)
+
+    async def classify(self, snapshot: Snapshot, object_parameters: ObjectParameters) -> bool:
+        """
+        Classifies an image for a single object.
+
+        Returns:
+            The "label" key of the JSON answer.
+        """
+        text = await self.generate(
+            contents=[object_parameters.prompt, snapshot.to_blob()],
+            generation_config=object_parameters.to_generation_config(),
+        )
+        json_string = text.replace("```json\n", "").replace("\n```", "")
+        return json.loads(json_string)["label"]
+
+
+async def predict_camera(
+    camera_with_image: CameraRecord,
+    classifier: GeminiClassifier,
+    multi_object_prediction: bool = False,
+    redis_client: RedisPal = None,
+    prediction_cache_key: str = "flooding_detection_prediction_cache",
+    prediction_cache_max_distance: int = -1,
+    prediction_cache_ttl: int = 900,
+) -> CameraRecord:
+    """
+    Classifies every object of a camera, reusing the same snapshot. See `get_prediction_queue`
+    for the meaning of each option.
+    """
+    metrics = get_stage_metrics()
+    camera_with_image.ai_classification = []
+    if not camera_with_image.attempt_classification:
+        log(f"Skipping prediction for {camera_with_image.id_camera}: not attempted.")
+        metrics.record("prediction", skipped=1)
+        camera_with_image.ai_classification = [
+            Classification(parameters=o, label=False, confidence=0.7)
+            for o in camera_with_image.objects
+        ]
+        return camera_with_image
+    if not camera_with_image.snapshot:
+        log(f"Skipping prediction for {camera_with_image.id_camera}: no image.")
+        metrics.record("prediction", no_image=1)
+        camera_with_image.ai_classification = [
+            Classification(parameters=o, label=None, confidence=0.7)
+            for o in camera_with_image.objects
+        ]
+        return camera_with_image
+
+    snapshot = camera_with_image.snapshot
+    objects = camera_with_image.objects
+
+    # Objects already ruled out by the local pre-filter don't go to the model
+    labels = dict(camera_with_image.prefilter_labels)
+    sources = dict.fromkeys(labels, "prefilter")
+    if labels:
+        metrics.record("prediction", prefilter_skips=len(labels))
+
+    # Reuse labels predicted for a nearly identical frame with the same parameters
+    # Redis calls run in the default executor, not to block the other cameras' requests
+    loop = asyncio.get_running_loop()
+    use_prediction_cache = redis_client is not None and prediction_cache_max_distance >= 0
+    if use_prediction_cache:
+        image_hash = get_perceptual_hash(snapshot.decode(cv2.IMREAD_GRAYSCALE))
+        for object_parameters in objects:
+            if object_parameters.object in labels:
+                continue
+            cached_label = await loop.run_in_executor(
+                None,
+                partial(
+                    redis_get_cached_prediction,
+                    key=f"{prediction_cache_key}_{camera_with_image.id_camera}_{object_parameters.object}",  # noqa
+                    image_hash=image_hash,
+                    parameters_hash=get_prediction_parameters_hash(
+                        classifier.model_name, object_parameters
+                    ),
+                    max_distance=prediction_cache_max_distance,
+                    redis_client=redis_client,
+                ),
+            )
+            if cached_label is not None:
+                log(f"Using cached prediction for {object_parameters.object}: {cached_label}")
+                metrics.record("prediction", cache_hits=1)
+                labels[object_parameters.object] = cached_label
+                sources[object_parameters.object] = "cache"
+    pending_objects = [o for o in objects if o.object not in labels]
+
+    request_parameters = {}
+    try:
+        if multi_object_prediction and len(pending_objects) > 1:
+            multi_object_parameters = replace(
+                pending_objects[0],
+                max_output_token=sum(o.max_output_token for o in pending_objects),
+            )
+            text = await classifier.generate(
+                contents=[build_multi_object_prompt(pending_objects), snapshot.to_blob()],
+                generation_config=multi_object_parameters.to_generation_config(),
+            )
+            labels.update(parse_multi_object_response(text, pending_objects))
+            sources.update(dict.fromkeys((o.object for o in pending_objects), "model"))
+            for object_parameters in pending_objects:
+                request_parameters[object_parameters.object] = replace(
+                    object_parameters,
+                    max_output_token=multi_object_parameters.max_output_token,
+                    temperature=multi_object_parameters.temperature,
+                    top_k=multi_object_parameters.top_k,
+                    top_p=multi_object_parameters.top_p,
+                )
+        else:
+            pending_labels = await asyncio.gather(
+                *[classifier.classify(snapshot, object_parameters=o) for o in pending_objects]
+            )
+            labels.update({o.object: label for o, label in zip(pending_objects, pending_labels)})
+            sources.update(dict.fromkeys((o.object for o in pending_objects), "model"))
+        log(f"Successfully got predictions for {camera_with_image.id_camera}: {labels}")
+        metrics.record("prediction", succeeded=1)
+    except Exception as exc:
+        log(
+            f"Failed to get predictions for {camera_with_image.id_camera}: {exc}",
+            level="warning",
+        )
+        metrics.record("prediction", failures=1)
+        pending_objects = []
+
+    if use_prediction_cache:
+        for object_parameters in pending_objects:
+            if labels.get(object_parameters.object) is None:
+                continue
+            await loop.run_in_executor(
+                None,
+                partial(
+                    redis_set_cached_prediction,
+                    key=f"{prediction_cache_key}_{camera_with_image.id_camera}_{object_parameters.object}",  # noqa
+                    image_hash=image_hash,
+                    parameters_hash=get_prediction_parameters_hash(
+                        classifier.model_name, object_parameters
+                    ),
+                    label=labels[object_parameters.object],
+                    redis_client=redis_client,
+                    ttl=prediction_cache_ttl,
+                ),
+            )
+
+    camera_with_image.ai_classification = [
+        Classification(
+            parameters=request_parameters.get(o.object, o),
+            label=labels.get(o.object),
+            confidence=0.7,
+            source=sources.get(o.object) if labels.get(o.object) is not None else None,
+        )
+        for o in objects
+    ]
+    return camera_with_image
+
+
+class PredictionQueue:
+    """
+    Classifies cameras with `predict_camera` in a background event loop as soon as they are
+    submitted, so predictions start while the snapshots of other cameras are still being
+    taken. All requests share `classifier`, and its rate limiter.
+
+    Args:
+        classifier: The classifier shared by all requests.
+        on_prediction: Called, in the loop's default executor, with each camera as soon as
+            it is classified.
+        **kwargs: Passed to `predict_camera`.
+    """
+
+    def __init__(
+        self,
+        classifier: GeminiClassifier,
+        on_prediction: Callable[[List[CameraRecord]], None] = None,
+        **kwargs,
+    ):
+        self.classifier = classifier
+        self.on_prediction = on_prediction
+        self.kwargs = kwargs
+        self._futures: Dict[concurrent.futures.Future, CameraRecord] = {}
+        self._lock = threading.Lock()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def submit(self, camera_with_image: CameraRecord) -> None:
+        """
+        Starts classifying a camera.
+        """
+        future = asyncio.run_coroutine_threadsafe(self._predict(camera_with_image), self._loop)
+        with self._lock:
+            self._futures[future] = camera_with_image
+
+    def results(self, deadline: float = None) -> List[CameraRecord]:
+        """
+        Waits for the cameras submitted so far, and stops the loop.
+
+        Args:
+            deadline: Timestamp after which the predictions still running are cancelled.
+                Their cameras are returned with `attempt_classification` set to `False`.
+
+        Returns:
+            The cameras with image and classification.
+        """
+        with self._lock:
+            futures = dict(self._futures)
+        timeout = None if deadline is None else max(deadline - time.time(), 0)
+        _, pending = concurrent.futures.wait(futures, timeout=timeout)
+        # A future that can't be cancelled has just finished
+        dropped = [future for future in pending if future.cancel()]
+        results = []
+        for future, camera in futures.items():
+            if future in dropped:
+                camera.attempt_classification = False
+            elif future.exception() is not None:
+                log(f"Failed to predict {camera.id_camera}: {future.exception()}", level="warning")
+                camera.attempt_classification = False
+            results.append(camera)
+        if dropped:
+            log(f"Dropped {len(dropped)} predictions at the cycle deadline.", level="warning")
+            get_stage_metrics().record("prediction", deadline_drops=len(dropped))
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        return results
+
+    async def _predict(self, camera_with_image: CameraRecord) -> CameraRecord:
+        camera = await predict_camera(camera_with_image, self.classifier, **self.kwargs)
+        if self.on_prediction is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.on_prediction, [camera])
+        return camera
+
+    async def _shutdown(self):
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.get_running_loop().shutdown_default_executor()
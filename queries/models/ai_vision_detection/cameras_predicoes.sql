@@ -1,6 +1,7 @@
 {{
     config(
         materialized='incremental',
+        on_schema_change='append_new_columns',
         partition_by={
             "field": "data_particao",
             "data_type": "date",
@@ -17,18 +18,19 @@ SELECT
   object,
   label,
   CAST(confidence AS FLOAT64) AS confidence,
+  source,
   prompt,
   CAST(max_output_token AS INT64) AS max_output_token,
   CAST(temperature AS FLOAT64) AS temperature,
   CAST(top_k AS INT64) AS top_k,
-  CAST(top_p AS INT64) AS top_p,
+  CAST(top_p AS FLOAT64) AS top_p,
   CAST(latitude AS FLOAT64) AS latitude,
   CAST(longitude AS FLOAT64) AS longitude,
   ST_GEOGPOINT(
     CAST(longitude AS FLOAT64),
     CAST(CAST(longitude AS FLOAT64) AS FLOAT64)
   ) AS geometry,
-  image_base64,
+  image_uri,
   CAST(data_particao AS DATE) data_particao,
 FROM `rj-escritorio-dev.ai_vision_detection_staging.cameras_predicoes`
 WHERE CAST(data_particao AS DATE) < CURRENT_DATE('America/Sao_Paulo')